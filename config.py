@@ -27,3 +27,24 @@ DB_VOCAB_SCHEMA = os.environ.get('YAOL_DB_VOCAB_SCHEMA',DB_OMOP_SCHEMA)
 DB_RESULTS_SCHEMA = os.environ.get('YAOL_DB_RESULTS_SCHEMA','results')
 #: Path to a zip file containg OMOP vocabulary files as downlaoded from Athena. Set from the YAOL_VOCAB_ZIP env var.
 VOCABS_ZIP = os.environ.get('YAOL_VOCAB_ZIP')
+#: Have the database server read data and vocab files directly (COPY FROM file/PROGRAM) when it shares storage with the loader. Set from the YAOL_SERVER_COPY env var.
+SERVER_COPY = os.environ.get('YAOL_SERVER_COPY','false').lower() in ('true','1','yes')
+#: Load a consistent sample of persons, given as a fraction (below 1) or a count of persons. Loads all persons if not set. Set from the YAOL_SAMPLE_PERSONS env var.
+SAMPLE_PERSONS = os.environ.get('YAOL_SAMPLE_PERSONS')
+#: Comma separated vocabulary_ids to load concepts from. Loads all vocabularies if neither this or VOCAB_DOMAINS is set. Must include every vocabulary the data uses for its foreign keys to build. Set from the YAOL_VOCAB_IDS env var.
+VOCAB_IDS = os.environ.get('YAOL_VOCAB_IDS','')
+#: Comma separated domain_ids to load concepts from. Loads all domains if neither this or VOCAB_IDS is set. Set from the YAOL_VOCAB_DOMAINS env var.
+VOCAB_DOMAINS = os.environ.get('YAOL_VOCAB_DOMAINS','')
+#: Number of connections the index, derive, snapshot and restore actions use at once. Set from the YAOL_WORKERS env var.
+WORKERS = int(os.environ.get('YAOL_WORKERS','4'))
+#: Path to the folder the snapshot action writes to and the restore action reads from. Set from the YAOL_SNAPSHOT_PATH env var.
+SNAPSHOT_PATH = os.environ.get('YAOL_SNAPSHOT_PATH','snapshot')
+#: Tables to build as partitioned tables, as a comma separated list of table=method where method is hash (on person_id) or range (on the event date).
+#: A column can be given as method:column, e.g. measurement=hash,drug_exposure=range:drug_exposure_start_date. Set from the YAOL_PARTITION_TABLES env var.
+PARTITION_TABLES = os.environ.get('YAOL_PARTITION_TABLES','')
+#: Number of partitions to create for each hash partitioned table. Set from the YAOL_PARTITION_HASH_COUNT env var.
+PARTITION_HASH_COUNT = int(os.environ.get('YAOL_PARTITION_HASH_COUNT','8'))
+#: First year to create a yearly partition for on range partitioned tables. Set from the YAOL_PARTITION_RANGE_START env var.
+PARTITION_RANGE_START = int(os.environ.get('YAOL_PARTITION_RANGE_START','2000'))
+#: Last year to create a yearly partition for on range partitioned tables. Dates outside the range go to a default partition. Set from the YAOL_PARTITION_RANGE_END env var.
+PARTITION_RANGE_END = int(os.environ.get('YAOL_PARTITION_RANGE_END','2030'))
@@ -3,6 +3,10 @@ import logging
 
 logger = logging.getLogger(__name__)
 
+#: The OMOP vocabulary tables. These are built in the vocab schema and loaded from the vocab zip file.
+VOCAB_TABLES = ['concept', 'concept_ancestor', 'concept_class', 'concept_relationship', 'concept_synonym', 'domain',
+                'drug_strength', 'relationship', 'vocabulary']
+
 def schema_exists(conn:psycopg.connection,schema_name:str)->bool:
     """
     Checks whether the given schema exists.
@@ -106,7 +110,247 @@ def is_vocab_table(table_name:str)->bool:
     table_name = table_name[-1] # Get the table name (even if there was no schema)
     table_name = table_name.lower().strip()
     logger.debug("Checking if %s is a vocab table" % table_name)
-    vocab_tables = ['concept', 'concept_ancestor', 'concept_class', 'concept_relationship', 'concept_synonym', 'domain',
-                    'drug_strength', 'relationship', 'vocabulary']
+    return (table_name in VOCAB_TABLES)
+
+def partition_columns(conn:psycopg.connection,schema_name:str,table_name:str)->list[str]:
+    """
+    Gets the columns making up the partition key of the given table.
+
+    :param conn: A psycopg connection object to the postgres database
+    :type conn: psycopg.connection
+    :param schema_name: The name of the schema containing the table.
+    :type schema_name: str
+    :param table_name: The name of the table to check.
+    :type table_name: str
+
+    :returns: A list of the partition key columns. Empty if the table is not partitioned.
+    :rtype: list
+    """
+    table_name = table_name.split(".")[-1].lower().strip()
+    logger.debug("Checking partition key of %s.%s" % (schema_name,table_name))
+    sql = """SELECT a.attname FROM pg_partitioned_table p
+             JOIN pg_class c ON c.oid=p.partrelid
+             JOIN pg_namespace n ON n.oid=c.relnamespace
+             JOIN pg_attribute a ON a.attrelid=p.partrelid AND a.attnum=ANY(p.partattrs::int2[])
+             WHERE n.nspname='%s' AND c.relname='%s'""" % (schema_name,table_name)
+    with conn.cursor() as cur:
+        res = cur.execute(sql)
+        columns = [row[0] for row in res.fetchall()]
+        logger.debug("Partition columns are %s" % columns)
+        return columns
+    return None
+
+def can_copy_on_server(conn:psycopg.connection,program:bool=False)->bool:
+    """
+    Checks whether the current user can run server side COPY statements. Reading files requires superuser or membership of
+    pg_read_server_files. Running programs requires superuser or membership of pg_execute_server_program.
+
+    :param conn: A psycopg connection object to the postgres database
+    :type conn: psycopg.connection
+    :param program: Check for COPY ... FROM PROGRAM rather than COPY ... FROM 'file'. Defaults to False.
+    :type program: bool
+
+    :returns: True if the user has the required privilege
+    :rtype: bool
+    """
+    role = 'pg_execute_server_program' if program else 'pg_read_server_files'
+    logger.debug("Checking current user is superuser or member of %s" % role)
+    sql = "SELECT rolsuper OR pg_has_role(current_user,'%s','MEMBER') FROM pg_roles WHERE rolname=current_user" % role
+    with conn.cursor() as cur:
+        res = cur.execute(sql)
+        allowed = bool(res.fetchone()[0])
+        logger.debug("Server copy allowed is %s" % allowed)
+        return allowed
+    return None
+
+def list_tables(conn:psycopg.connection,schema_name:str)->list[str]:
+    """
+    Lists the tables in the given schema, largest first. Partitioned tables are listed once with the size of all their partitions 
+    and the partitions themselves are not listed.
+
+    :param conn: A psycopg connection object to the postgres database
+    :type conn: psycopg.connection
+    :param schema_name: The name of the schema.
+    :type schema_name: str
+
+    :returns: A list of table names
+    :rtype: list
+    """
+    logger.debug("Listing tables in %s" % schema_name)
+    sql = """SELECT c.relname FROM pg_class c JOIN pg_namespace n ON n.oid=c.relnamespace
+             WHERE n.nspname='%s' AND c.relkind IN ('r','p') AND NOT c.relispartition
+             ORDER BY (SELECT sum(pg_total_relation_size(relid)) FROM pg_partition_tree(c.oid)) DESC, c.relname""" % schema_name
+    with conn.cursor() as cur:
+        res = cur.execute(sql)
+        tables = [row[0] for row in res.fetchall()]
+        logger.debug("Tables are %s" % tables)
+        return tables
+    return None
+
+def table_columns(conn:psycopg.connection,schema_name:str,table_name:str)->list[str]:
+    """
+    Gets the column names of the given table in column order.
+
+    :param conn: A psycopg connection object to the postgres database
+    :type conn: psycopg.connection
+    :param schema_name: The name of the schema containing the table.
+    :type schema_name: str
+    :param table_name: The name of the table.
+    :type table_name: str
+
+    :returns: A list of column names
+    :rtype: list
+    """
+    logger.debug("Getting columns of %s.%s" % (schema_name,table_name))
+    sql = "SELECT column_name FROM information_schema.columns WHERE table_schema='%s' AND table_name='%s' ORDER BY ordinal_position" % (
+        schema_name,table_name)
+    with conn.cursor() as cur:
+        res = cur.execute(sql)
+        columns = [row[0] for row in res.fetchall()]
+        logger.debug("Columns are %s" % columns)
+        return columns
+    return None
+
+def list_partitions(conn:psycopg.connection,schema_name:str,table_name:str)->list[str]:
+    """
+    Lists the partitions of the given partitioned table.
+
+    :param conn: A psycopg connection object to the postgres database
+    :type conn: psycopg.connection
+    :param schema_name: The name of the schema containing the table.
+    :type schema_name: str
+    :param table_name: The name of the partitioned table.
+    :type table_name: str
+
+    :returns: A list of partition names. Empty if the table is not partitioned.
+    :rtype: list
+    """
+    table_name = table_name.split(".")[-1].lower().strip()
+    logger.debug("Listing partitions of %s.%s" % (schema_name,table_name))
+    sql = """SELECT c.relname FROM pg_inherits i
+             JOIN pg_class c ON c.oid=i.inhrelid
+             JOIN pg_class p ON p.oid=i.inhparent
+             JOIN pg_namespace n ON n.oid=p.relnamespace
+             WHERE n.nspname='%s' AND p.relname='%s' AND p.relkind='p'
+             ORDER BY c.relname""" % (schema_name,table_name)
+    with conn.cursor() as cur:
+        res = cur.execute(sql)
+        partitions = [row[0] for row in res.fetchall()]
+        logger.debug("Partitions are %s" % partitions)
+        return partitions
+    return None
+
+def column_is_indexed(conn:psycopg.connection,schema_name:str,table_name:str,column_name:str)->bool:
+    """
+    Checks whether the given table has an index whose first column is the given column.
+
+    :param conn: A psycopg connection object to the postgres database
+    :type conn: psycopg.connection
+    :param schema_name: The name of the schema containing the table.
+    :type schema_name: str
+    :param table_name: The name of the table to check.
+    :type table_name: str
+    :param column_name: The name of the column to check.
+    :type column_name: str
+
+    :returns: True if an index starts with the column
+    :rtype: bool
+    """
+    table_name = table_name.split(".")[-1].lower().strip()
+    logger.debug("Checking for an index on %s.%s (%s)" % (schema_name,table_name,column_name))
+    sql = """SELECT i.indexrelid FROM pg_index i
+             JOIN pg_class c ON c.oid=i.indrelid
+             JOIN pg_namespace n ON n.oid=c.relnamespace
+             JOIN pg_attribute a ON a.attrelid=i.indrelid AND a.attnum=i.indkey[0]
+             WHERE n.nspname='%s' AND c.relname='%s' AND a.attname='%s'""" % (schema_name,table_name,column_name)
+    with conn.cursor() as cur:
+        res = cur.execute(sql)
+        exists = cur.rowcount>0
+        logger.debug("Index exists is %s" % exists)
+        return exists
+    return None
+
+def table_column_types(conn:psycopg.connection,schema_name:str,table_name:str)->list[tuple[str,str]]:
+    """
+    Gets the column names and types of the given table in column order. Types are as given by format_type e.g. numeric(10,2).
+
+    :param conn: A psycopg connection object to the postgres database
+    :type conn: psycopg.connection
+    :param schema_name: The name of the schema containing the table.
+    :type schema_name: str
+    :param table_name: The name of the table.
+    :type table_name: str
 
-    return (table_name in vocab_tables)
\ No newline at end of file
+    :returns: A list of tuples of (column name,type)
+    :rtype: list
+    """
+    logger.debug("Getting column types of %s.%s" % (schema_name,table_name))
+    sql = """SELECT a.attname, format_type(a.atttypid,a.atttypmod) FROM pg_attribute a
+             JOIN pg_class c ON c.oid=a.attrelid
+             JOIN pg_namespace n ON n.oid=c.relnamespace
+             WHERE n.nspname='%s' AND c.relname='%s' AND a.attnum>0 AND NOT a.attisdropped
+             ORDER BY a.attnum""" % (schema_name,table_name)
+    with conn.cursor() as cur:
+        res = cur.execute(sql)
+        columns = [(row[0],row[1]) for row in res.fetchall()]
+        logger.debug("Column types are %s" % columns)
+        return columns
+    return None
+
+def list_leaf_partitions(conn:psycopg.connection,schema_name:str,table_name:str)->list[str]:
+    """
+    Lists the partitions of the given partitioned table which hold data, i.e. including the partitions of any sub-partitioned
+    partitions, largest first.
+
+    :param conn: A psycopg connection object to the postgres database
+    :type conn: psycopg.connection
+    :param schema_name: The name of the schema containing the table.
+    :type schema_name: str
+    :param table_name: The name of the partitioned table.
+    :type table_name: str
+
+    :returns: A list of partition names. Empty if the table is not partitioned.
+    :rtype: list
+    """
+    table_name = table_name.split(".")[-1].lower().strip()
+    logger.debug("Listing leaf partitions of %s.%s" % (schema_name,table_name))
+    sql = """SELECT c.relname FROM pg_partition_tree('%s.%s') t
+             JOIN pg_class c ON c.oid=t.relid
+             WHERE t.isleaf AND t.level>0
+             ORDER BY pg_total_relation_size(t.relid) DESC, c.relname""" % (schema_name,table_name)
+    with conn.cursor() as cur:
+        res = cur.execute(sql)
+        partitions = [row[0] for row in res.fetchall()]
+        logger.debug("Leaf partitions are %s" % partitions)
+        return partitions
+    return None
+
+def primary_key_columns(conn:psycopg.connection,schema_name:str,table_name:str)->list[str]:
+    """
+    Gets the columns of the primary key of the given table, in key order, from the catalog.
+
+    :param conn: A psycopg connection object to the postgres database
+    :type conn: psycopg.connection
+    :param schema_name: The name of the schema containing the table.
+    :type schema_name: str
+    :param table_name: The name of the table.
+    :type table_name: str
+
+    :returns: A list of the key columns. Empty if the table has no primary key.
+    :rtype: list
+    """
+    table_name = table_name.split(".")[-1].lower().strip()
+    logger.debug("Getting primary key of %s.%s" % (schema_name,table_name))
+    sql = """SELECT a.attname FROM pg_constraint k
+             JOIN pg_class c ON c.oid=k.conrelid
+             JOIN pg_namespace n ON n.oid=c.relnamespace
+             JOIN LATERAL unnest(k.conkey) WITH ORDINALITY AS u(attnum,position) ON true
+             JOIN pg_attribute a ON a.attrelid=k.conrelid AND a.attnum=u.attnum
+             WHERE k.contype='p' AND n.nspname='%s' AND c.relname='%s'
+             ORDER BY u.position""" % (schema_name,table_name)
+    with conn.cursor() as cur:
+        res = cur.execute(sql)
+        columns = [row[0] for row in res.fetchall()]
+        logger.debug("Primary key columns are %s" % columns)
+        return columns
+    return None
@@ -1,10 +1,21 @@
 import os
 import os.path
+import io
+import gzip
+import json
+import datetime
 import re
+import csv
+import zlib
+import heapq
+import bisect
+import array
+import shlex
 import sys
 import zipfile
 import argparse
 import logging
+import concurrent.futures
 import sys
 
 import psycopg
@@ -15,6 +26,16 @@ import dbutils
 
 logger = logging.getLogger(__name__)
 
+#: The tables built from the CDM data by :py:func:`derive_cdm`. Tables after observation_period get their ids from a sequence.
+DERIVED_TABLES = ['observation_period','condition_era','drug_era','dose_era']
+#: The tables the derived tables are built from. Persons whose rows in these are loaded or merged are recorded by :py:func:`mark_derive_persons`.
+DERIVE_EVENT_TABLES = ['visit_occurrence','condition_occurrence','drug_exposure','procedure_occurrence','device_exposure','measurement','observation']
+#: Tables with a person_id whose ids are referenced by tables without one when sampling persons, as {table:id column}.
+SAMPLE_PARENT_TABLES = {'episode':'episode_id','note':'note_id'}
+#: Vocabularies whose concepts are always kept when filtering vocabs. The vocab tables reference the first six, every CDM event row has
+#: a type concept (as do the rows built by :py:func:`derive_cdm`) and every person and visit row references the others.
+VOCAB_FILTER_ALWAYS = ['None','Vocabulary','Domain','Concept Class','Relationship','UCUM','Type Concept','Gender','Race','Ethnicity','Visit']
+
 def add_schema(ddl_file:str,schema_name:str,vocab_schema_name:str)->str:
     '''
     Reads an OMOP DDL file as downloaded from the OHDSI github and replaces the schema template variable
@@ -66,6 +87,116 @@ def run_sql_template(conn:psycopg.connection,schema_name:str,vocab_schema_name:s
         cur.execute(sql_queries)
     return None
 
+def parse_partition_spec(partition_spec:str)->dict[str,tuple[str,str]]:
+    """
+    Parses a partition specification as set in :py:data:`config.PARTITION_TABLES` into a map of table name to partition method and column.
+    Hash partitions default to the person_id column. Range partitions default to None, meaning the event date column is taken from the DDL.
+
+    :param partition_spec: A comma separated list of table=method or table=method:column entries. Method is one of hash or range.
+    :type partition_spec: str
+
+    :returns: A dict of {table name:(method,column)}
+    :rtype: dict
+    """
+    partitions = {}
+    if not partition_spec:
+        return partitions
+    for entry in partition_spec.split(','):
+        entry = entry.strip()
+        if not entry:
+            continue
+        table_name,_,method = entry.partition('=')
+        method,_,column = method.partition(':')
+        table_name = table_name.strip().lower()
+        method = method.strip().lower()
+        column = column.strip().lower() or None
+        if method not in ('hash','range'):
+            raise ValueError("Unknown partition method '%s' for table %s. Expected hash or range" % (method,table_name))
+        if method=='hash' and column is None:
+            column = 'person_id'
+        logger.debug("Partitioning %s by %s on %s" % (table_name,method,column))
+        partitions[table_name] = (method,column)
+    return partitions
+
+def add_partitions(ddl:str,partitions:dict[str,tuple[str,str]])->str:
+    """
+    Adds a PARTITION BY clause to the CREATE TABLE statements of the given tables in an OMOP DDL string.
+    Where a range partitioned table has no column set, the first NOT NULL date column of the table is used.
+
+    :param ddl: The DDL as returned from :py:func:`add_schema`.
+    :type ddl: str
+    :param partitions: A dict of {table name:(method,column)} as returned from :py:func:`parse_partition_spec`.
+    :type partitions: dict
+
+    :returns: A string containing the DDL with the partition clauses added.
+    :rtype: str
+    """
+    for table_name,(method,column) in partitions.items():
+        create_statement = re.search('CREATE TABLE IF NOT EXISTS [^\s]+\.%s \((.*?)\)\s*;' % table_name,ddl,re.IGNORECASE|re.DOTALL)
+        if create_statement is None:
+            raise ValueError("Table %s not found in DDL. Cannot partition" % table_name)
+        if column is None:
+            date_column = re.search('(\w+_date) date NOT NULL',create_statement.group(1),re.IGNORECASE)
+            if date_column is None:
+                raise ValueError("Table %s has no NOT NULL date column to range partition on" % table_name)
+            column = date_column.group(1).lower()
+        logger.debug("Adding partition by %s (%s) to %s" % (method,column,table_name))
+        statement = create_statement.group(0)
+        partitioned_statement = re.sub('\)\s*;$',') PARTITION BY %s (%s);' % (method.upper(),column),statement)
+        ddl = ddl.replace(statement,partitioned_statement)
+    return ddl
+
+def build_partitions(conn:psycopg.connection,schema_name:str,vocab_schema_name:str,partitions:dict[str,tuple[str,str]],
+                     hash_count:int,range_start:int,range_end:int)->None:
+    """
+    Creates the partitions of each partitioned table. Hash partitioned tables get hash_count partitions and range partitioned tables get
+    one partition per year from range_start to range_end plus a default partition. Does nothing if the partitions already exist.
+    Tables which were created before partitioning was configured are left as they are.
+
+    :param conn: A psycopg connection object to the postgres database
+    :type conn: psycopg.connection
+    :param schema_name: The name of the CDM schema containing the tables.
+    :type schema_name: str
+    :param vocab_schema_name: The name of the CDM schema containing the vocab tables.
+    :type vocab_schema_name: str
+    :param partitions: A dict of {table name:(method,column)} as returned from :py:func:`parse_partition_spec`.
+    :type partitions: dict
+    :param hash_count: The number of partitions to create for hash partitioned tables.
+    :type hash_count: int
+    :param range_start: The first year to create a partition for on range partitioned tables.
+    :type range_start: int
+    :param range_end: The last year to create a partition for on range partitioned tables.
+    :type range_end: int
+
+    :returns: None
+    :rtype: None
+    """
+    for table_name,(method,column) in partitions.items():
+        if dbutils.is_vocab_table(table_name):
+            table_schema = vocab_schema_name
+        else:
+            table_schema = schema_name
+        if not dbutils.partition_columns(conn,table_schema,table_name):
+            logger.warning("Table %s.%s exists and is not partitioned. Not adding partitions" % (table_schema,table_name))
+            continue
+        with conn.cursor() as cur:
+            if method=='hash':
+                for remainder in range(hash_count):
+                    sql = "CREATE TABLE IF NOT EXISTS %s.%s_p%d PARTITION OF %s.%s FOR VALUES WITH (MODULUS %d, REMAINDER %d)" % (
+                        table_schema,table_name,remainder,table_schema,table_name,hash_count,remainder)
+                    logger.debug(sql)
+                    cur.execute(sql)
+            else:
+                for year in range(range_start,range_end+1):
+                    sql = "CREATE TABLE IF NOT EXISTS %s.%s_%d PARTITION OF %s.%s FOR VALUES FROM ('%d-01-01') TO ('%d-01-01')" % (
+                        table_schema,table_name,year,table_schema,table_name,year,year+1)
+                    logger.debug(sql)
+                    cur.execute(sql)
+                sql = "CREATE TABLE IF NOT EXISTS %s.%s_default PARTITION OF %s.%s DEFAULT" % (table_schema,table_name,table_schema,table_name)
+                logger.debug(sql)
+                cur.execute(sql)
+    return None
+
 def drop_cdm(conn:psycopg.connection,schema_name:str,vocab_schema_name:str,results_schema_name:str)->None:
     """
     Drops the specifed schemas from the database. Does nothing if they calready exist.
@@ -105,10 +236,12 @@ def drop_cdm(conn:psycopg.connection,schema_name:str,vocab_schema_name:str,resul
         logger.debug("Schema %s does not exist. Not dropping" % (results_schema_name,))
     return None
 
-def build_cdm(conn:psycopg.connection,schema_name:str,vocab_schema_name:str,ddl_file:str,results_schema_name:str)->None:
+def build_cdm(conn:psycopg.connection,schema_name:str,vocab_schema_name:str,ddl_file:str,results_schema_name:str,
+              partitions:dict[str,tuple[str,str]]=None,hash_count:int=8,range_start:int=2000,range_end:int=2030)->None:
     """
     Build the OMOP CDM Tables by executing the OMOP DDL file. 
     Does nothing if the already exist (by replacing the CREATE TABLE statements with CREATE TABLE IF NOT EXISTS statements)
+    Any tables in partitions are created as partitioned tables by calling :py:func:`add_partitions` and :py:func:`build_partitions`.
 
     :param conn: A psycopg connection object to the postgres database
     :type conn: psycopg.connection
@@ -118,6 +251,14 @@ def build_cdm(conn:psycopg.connection,schema_name:str,vocab_schema_name:str,ddl_
     :type vocab_schema_name: str
     :param results_schema_name: The name of the results schema to create and build the results the tables in (not currently used)
     :type results_schema_name: str
+    :param partitions: A dict of {table name:(method,column)} as returned from :py:func:`parse_partition_spec`. Defaults to no partitioned tables.
+    :type partitions: dict
+    :param hash_count: The number of partitions to create for hash partitioned tables.
+    :type hash_count: int
+    :param range_start: The first year to create a partition for on range partitioned tables.
+    :type range_start: int
+    :param range_end: The last year to create a partition for on range partitioned tables.
+    :type range_end: int
 
     :returns: None
     :rtype: None
@@ -144,12 +285,40 @@ def build_cdm(conn:psycopg.connection,schema_name:str,vocab_schema_name:str,ddl_
     else:
         logger.debug("Schema %s exists. Not creating" % results_schema_name)
     #TODO Change this to go table by table getting the correct schema as we go.
-    run_sql_template(conn,schema_name,vocab_schema_name,ddl_file)
+    if partitions:
+        ddl = add_partitions(add_schema(ddl_file,schema_name,vocab_schema_name),partitions)
+        with conn.cursor() as cur:
+            cur.execute(ddl)
+        build_partitions(conn,schema_name,vocab_schema_name,partitions,hash_count,range_start,range_end)
+    else:
+        run_sql_template(conn,schema_name,vocab_schema_name,ddl_file)
+    return None
+
+def build_partition_index(conn_str:str,sql:str)->None:
+    """
+    Creates the index on one partition of a partitioned table on a new connection. Run by :py:func:`build_indicies` for each partition in parallel.
+
+    :param conn_str: The postgres connection string.
+    :type conn_str: str
+    :param sql: The CREATE INDEX statement for the partition.
+    :type sql: str
+
+    :returns: None
+    :rtype: None
+    """
+    logger.debug("Running %s" % sql)
+    with psycopg.connect(conn_str) as conn:
+        with conn.cursor() as cur:
+            cur.execute(sql)
+        conn.commit()
     return None
 
-def build_indicies(conn:psycopg.connection,schema_name:str,vocab_schema_name:str,indices_file:str)->None:
+def build_indicies(conn:psycopg.connection,schema_name:str,vocab_schema_name:str,indices_file:str,conn_str:str=None,workers:int=1)->None:
     """
     Build the OMOP CDM Indexes by executing the OMOP Indexes file. Does nothing if they already exist.
+    Indexes on partitioned tables are created ON ONLY the parent table, then built on each partition separately and attached to the parent.
+    If workers is more than 1 the partition indexes are built in parallel by :py:func:`build_partition_index`, each on its own connection
+    and committed separately, so the partitioned tables must already be committed.
 
     :param conn: A psycopg connection object to the postgres database
     :type conn: psycopg.connection
@@ -159,12 +328,17 @@ def build_indicies(conn:psycopg.connection,schema_name:str,vocab_schema_name:str
     :type vocab_schema_name: str
     :param indices_file: The name of the file containing the SQL statements to create the indexes.
     :type indices_file: str
+    :param conn_str: The postgres connection string used to build partition indexes in parallel. Defaults to None.
+    :type conn_str: str
+    :param workers: The number of partition indexes to build at once. Defaults to 1 which builds them on conn.
+    :type workers: int
 
     :returns: None
     :rtype: None
     """
     cluster_commands = []
     created_indexes = []
+    partition_indexes = []
     with open(indices_file) as f:
             for line in f:
                 sql = None
@@ -179,11 +353,24 @@ def build_indicies(conn:psycopg.connection,schema_name:str,vocab_schema_name:str
                     with conn.cursor() as cur:
                         if not dbutils.index_exists(conn,index_name):
                             if dbutils.is_vocab_table(table_name):
-                                sql = sql.replace('@cdmDatabaseSchema',vocab_schema_name)
+                                table_schema = vocab_schema_name
                             else:
-                                sql = sql.replace('@cdmDatabaseSchema',schema_name)
+                                table_schema = schema_name
+                            sql = sql.replace('@cdmDatabaseSchema',table_schema)
                             index_name = sql.split()[2]
-                            cur.execute(sql)
+                            partitions = dbutils.list_partitions(conn,table_schema,table_name)
+                            if partitions:
+                                parent_sql = re.sub(' ON [^\s]+',' ON ONLY %s.%s' % (table_schema,table_name.split('.')[-1]),sql,count=1)
+                                logger.debug("Running %s" % parent_sql.strip())
+                                cur.execute(parent_sql)
+                                for i,partition in enumerate(partitions):
+                                    partition_index = "%s_p%d" % (index_name,i)
+                                    partition_sql = re.sub('CREATE INDEX [^\s]+\s+ON [^\s]+',
+                                                           'CREATE INDEX IF NOT EXISTS %s ON %s.%s' % (partition_index,table_schema,partition),
+                                                           sql,count=1).strip()
+                                    partition_indexes.append((table_schema,index_name,partition_index,partition_sql))
+                            else:
+                                cur.execute(sql)
                             created_index = index_name
                             created_indexes.append(created_index)
                             logger.debug("Created index %s" % created_index)
@@ -191,6 +378,21 @@ def build_indicies(conn:psycopg.connection,schema_name:str,vocab_schema_name:str
                             logger.debug("Skipped index %s" % index_name)                    
                 elif line.startswith('CLUSTER'):
                     cluster_commands.append(line)
+    if partition_indexes:
+        logger.info("Building %d partition indexes" % len(partition_indexes))
+        if workers>1 and conn_str:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+                futures = [executor.submit(build_partition_index,conn_str,partition_sql) for _,_,_,partition_sql in partition_indexes]
+                for future in concurrent.futures.as_completed(futures):
+                    future.result()
+        else:
+            with conn.cursor() as cur:
+                for _,_,_,partition_sql in partition_indexes:
+                    logger.debug("Running %s" % partition_sql)
+                    cur.execute(partition_sql)
+        with conn.cursor() as cur:
+            for table_schema,index_name,partition_index,_ in partition_indexes:
+                cur.execute("ALTER INDEX %s.%s ATTACH PARTITION %s.%s" % (table_schema,index_name,table_schema,partition_index))
     with conn.cursor() as cur:
         for cluster_command in cluster_commands:
             index_name = cluster_command.split()[3]
@@ -205,6 +407,7 @@ def build_indicies(conn:psycopg.connection,schema_name:str,vocab_schema_name:str
 def build_pkeys(conn:psycopg.connection,schema_name:str,vocab_schema_name:str,pkeys_file:str)->None:
     """
     Build the OMOP CDM Primary Keys by executing the OMOP Primary Keys file. Does nothing if they already exist.
+    Keys on partitioned tables have the partition key columns added as postgres requires them in any primary key.
 
     :param conn: A psycopg connection object to the postgres database
     :type conn: psycopg.connection
@@ -234,6 +437,14 @@ def build_pkeys(conn:psycopg.connection,schema_name:str,vocab_schema_name:str,pk
                 else:
                     logger.debug("Making key in cdm schema %s" % schema_name)
                     sql = line.replace('@cdmDatabaseSchema',schema_name).strip()
+                table_schema = vocab_schema_name if dbutils.is_vocab_table(table_name) else schema_name
+                partition_columns = dbutils.partition_columns(conn,table_schema,table_name)
+                if partition_columns:
+                    key_columns = re.search('PRIMARY KEY \((.+?)\)',sql).group(1)
+                    columns = [c.strip() for c in key_columns.split(',')]
+                    columns += [c for c in partition_columns if c not in [k.lower() for k in columns]]
+                    logger.debug("Table %s is partitioned. Using key columns %s" % (table_name,columns))
+                    sql = sql.replace('PRIMARY KEY (%s)' % key_columns,'PRIMARY KEY (%s)' % ','.join(columns))
                 if not dbutils.key_exists(conn,key_name):
                     cur.execute(sql)
                     logger.debug("Added key %s" % sql)
@@ -244,6 +455,7 @@ def build_pkeys(conn:psycopg.connection,schema_name:str,vocab_schema_name:str,pk
 def build_fkeys(conn:psycopg.connection,schema_name:str,vocab_schema_name:str,constraints_file:str)->None:
     """
     Build the OMOP CDM foreign keys by executing the OMOP Constrains file. Does nothing if they already exist.
+    Keys referencing a partitioned table are skipped unless they include its partition key, as postgres has no unique key to reference.
 
     :param conn: A psycopg connection object to the postgres database
     :type conn: psycopg.connection
@@ -282,6 +494,14 @@ def build_fkeys(conn:psycopg.connection,schema_name:str,vocab_schema_name:str,co
                 else:
                     logger.debug("Referencing table in cdm schema %s" % reference_table_name)
                     sql = sql.replace(reference_table_name,"%s.%s" % (schema_name,reference_table_name.split('.')[1])).strip()
+                reference_schema = vocab_schema_name if dbutils.is_vocab_table(reference_table_name) else schema_name
+                partition_columns = dbutils.partition_columns(conn,reference_schema,reference_table_name)
+                if partition_columns:
+                    reference_columns = re.search('REFERENCES [^\s]+\s*\((.+?)\)',sql).group(1)
+                    reference_columns = [c.strip().lower() for c in reference_columns.split(',')]
+                    if not all(c in reference_columns for c in partition_columns):
+                        logger.warning("Skipped foreign key %s. Referenced table %s is partitioned on %s" % (key_name,reference_table_name,partition_columns))
+                        continue
                 if not dbutils.key_exists(conn,key_name):
                     cur.execute(sql)
                     logger.debug("Added foreign key %s" % sql)
@@ -312,7 +532,67 @@ def build_table_map(data_pattern:str,data_path:str)->list[tuple[str,str]]:
             table_map.append(tmap)
     return table_map
 
-def load_vocabs_from_zip(conn:psycopg.connection,db_schema:str,zip_file:str)->None:
+def copy_from_server(conn:psycopg.connection,query:str)->bool:
+    """
+    Runs a server side COPY ... FROM 'file' or COPY ... FROM PROGRAM statement inside a savepoint.
+    If the server cannot read the file, run the program or the user lacks the privilege the savepoint is rolled back so the caller can 
+    fall back to streaming the data from the client.
+
+    :param conn: A psycopg connection object to the postgres database
+    :type conn: psycopg.connection
+    :param query: The COPY statement to run.
+    :type query: str
+
+    :returns: True if the data was copied, False if the caller should fall back to a client side copy.
+    :rtype: bool
+    """
+    logger.debug(query)
+    try:
+        with conn.transaction():
+            with conn.cursor() as cur:
+                cur.execute(query)
+    except (psycopg.errors.InsufficientPrivilege,psycopg.errors.UndefinedFile,
+            psycopg.errors.IoError,psycopg.errors.ExternalRoutineException) as e:
+        logger.info("Server side copy failed. Falling back to client copy: %s" % (str(e).strip(),))
+        return False
+    return True
+
+def vocab_concept_ids(archive:zipfile.ZipFile,vocabulary_ids:list[str]=None,domain_ids:list[str]=None)->array.array:
+    """
+    Chooses the concepts to load in a single streaming pass over CONCEPT.csv in a vocab zip file. A concept is kept if its
+    vocabulary_id is in vocabulary_ids or its domain_id is in domain_ids. Concepts in the vocabularies listed in
+    :py:data:`VOCAB_FILTER_ALWAYS` are always kept as the vocab tables and the CDM tables' type, person and visit columns reference them.
+    N.B. The foreign keys from the CDM tables also need every other vocabulary the data uses.
+
+    :param archive: The vocab zip file as downloaded from Athena.
+    :type archive: zipfile.ZipFile
+    :param vocabulary_ids: The vocabulary_ids of the concepts to keep.
+    :type vocabulary_ids: list
+    :param domain_ids: The domain_ids of the concepts to keep.
+    :type domain_ids: list
+
+    :returns: A sorted array of the concept_ids to keep. Use :py:func:`id_in_array` to check membership.
+    :rtype: array.array
+    """
+    vocabulary_ids = set(vocabulary_ids or []) | set(VOCAB_FILTER_ALWAYS)
+    domain_ids = set(domain_ids or [])
+    logger.debug("Choosing concepts in vocabularies %s or domains %s" % (vocabulary_ids,domain_ids))
+    kept = []
+    with io.TextIOWrapper(archive.open('CONCEPT.csv'),encoding='utf-8') as f:
+        headers = [h.strip().lower() for h in f.readline().split('\t')]
+        concept_index = headers.index('concept_id')
+        domain_index = headers.index('domain_id')
+        vocabulary_index = headers.index('vocabulary_id')
+        for line in f:
+            row = line.rstrip('\r\n').split('\t')
+            if row[vocabulary_index] in vocabulary_ids or row[domain_index] in domain_ids:
+                kept.append(int(row[concept_index]))
+    kept = array.array('q',sorted(kept))
+    logger.info("Keeping %d concepts" % len(kept))
+    return kept
+
+def load_vocabs_from_zip(conn:psycopg.connection,db_schema:str,zip_file:str,server_copy:bool=False,
+                         vocabulary_ids:list[str]=None,domain_ids:list[str]=None)->None:
     """
     Loads OMOP vocabluaries from a zip file as downloaded from Athena. 
     N.B. This does not currently handle vocabs which require a license/post processing (e.g. CPT4).
@@ -323,33 +603,266 @@ def load_vocabs_from_zip(conn:psycopg.connection,db_schema:str,zip_file:str)->No
     :type schema_name: str
     :param zip_file: The path to the zip file containing vocab files.
     :type zip_file: str
+    :param server_copy: Have the database server read the zip file itself using COPY ... FROM PROGRAM 'unzip -p ...'. Falls back to 
+        streaming from the client if the server cannot. Defaults to False.
+    :type server_copy: bool
+    :param vocabulary_ids: Only load concepts from these vocabularies (or domain_ids). Defaults to None which loads all concepts.
+    :type vocabulary_ids: list
+    :param domain_ids: Only load concepts from these domains (or vocabulary_ids). Defaults to None which loads all concepts.
+    :type domain_ids: list
 
     :returns: None
     :rtype: None
     """
-    vocab_files = ['CONCEPT.csv','CONCEPT_ANCESTOR.csv','CONCEPT_CLASS.csv','CONCEPT_RELATIONSHIP.csv','CONCEPT_SYNONYM.csv','DOMAIN.csv',
-                   'DRUG_STRENGTH.csv','RELATIONSHIP.csv','VOCABULARY.csv']
+    filter_columns = {'concept':['concept_id'],
+                      'concept_ancestor':['ancestor_concept_id','descendant_concept_id'],
+                      'concept_relationship':['concept_id_1','concept_id_2'],
+                      'concept_synonym':['concept_id'],
+                      'drug_strength':['drug_concept_id','ingredient_concept_id']}
     logger.debug("Loading vocabs from %s" % zip_file)
+    if server_copy and not dbutils.can_copy_on_server(conn,program=True):
+        logger.info("User cannot run programs on the server. Loading vocabs from the client")
+        server_copy = False
     archive = zipfile.ZipFile(zip_file, 'r')
-    for vocab_file in vocab_files:
-        with conn.cursor() as cur:
-            with archive.open(vocab_file) as f:
-                logger.debug("Checking %s" % vocab_file)
-                table_name = vocab_file.replace(".csv","")
-                if dbutils.table_is_empty(conn,db_schema,table_name):
-                    logger.debug("Loading %s" % table_name)
-                    query = "COPY %s.%s FROM STDIN WITH(FORMAT CSV, HEADER, DELIMITER E'\\t', QUOTE E'\\b')" % (db_schema,table_name,)
+    concept_ids = None
+    if vocabulary_ids or domain_ids:
+        concept_ids = vocab_concept_ids(archive,vocabulary_ids,domain_ids)
+    for table_name in dbutils.VOCAB_TABLES:
+        table_name = table_name.upper()
+        vocab_file = "%s.csv" % table_name
+        logger.debug("Checking %s" % vocab_file)
+        if dbutils.table_is_empty(conn,db_schema,table_name):
+            logger.debug("Loading %s" % table_name)
+            copy_options = "WITH(FORMAT CSV, HEADER, DELIMITER E'\\t', QUOTE E'\\b')"
+            if concept_ids is not None and table_name.lower() in filter_columns:
+                with conn.cursor() as cur:
+                    with archive.open(vocab_file) as f:
+                        query = "COPY %s.%s FROM STDIN %s" % (db_schema,table_name,copy_options)
+                        logger.debug(query)
+                        with cur.copy(query) as copy:
+                            header = f.readline()
+                            copy.write(header)
+                            headers = [h.strip().lower() for h in header.decode('utf-8').split('\t')]
+                            column_indexes = [headers.index(c) for c in filter_columns[table_name.lower()]]
+                            kept = 0
+                            total = 0
+                            buffer = []
+                            for line in f:
+                                total += 1
+                                row = line.split(b'\t')
+                                if all(id_in_array(concept_ids,row[i]) for i in column_indexes):
+                                    buffer.append(line)
+                                    kept += 1
+                                    if len(buffer)>=1000:
+                                        copy.write(b''.join(buffer))
+                                        buffer = []
+                            copy.write(b''.join(buffer))
+                logger.info("Loaded %d of %d rows into %s" % (kept,total,table_name))
+                continue
+            if server_copy:
+                program = "unzip -p %s %s" % (shlex.quote(os.path.abspath(zip_file)),shlex.quote(vocab_file))
+                query = "COPY %s.%s FROM PROGRAM '%s' %s" % (db_schema,table_name,program.replace("'","''"),copy_options)
+                if copy_from_server(conn,query):
+                    continue
+            with conn.cursor() as cur:
+                with archive.open(vocab_file) as f:
+                    query = "COPY %s.%s FROM STDIN %s" % (db_schema,table_name,copy_options)
                     logger.debug(query)
                     with cur.copy(query) as copy:
                         while data := f.read(100):
                             copy.write(data)
-                else:
-                    logger.debug("Skippng table %s" % table_name)
+        else:
+            logger.debug("Skippng table %s" % table_name)
     return None
 
-def load_data_csv(conn:psycopg.connection,db_schema:str,table_map:tuple[str,str],delete_first=False)->None:
+def sample_person_ids(person_file:str,sample:float)->array.array:
+    """
+    Chooses a sample of person_ids in a single streaming pass over a person CSV file. Each person_id is hashed so the same
+    persons are chosen from the same file on every run. A sample below 1 is a fraction of persons to keep, otherwise it is a count.
+
+    :param person_file: The path to the person CSV file.
+    :type person_file: str
+    :param sample: The fraction (below 1) or number (1 or more) of persons to keep.
+    :type sample: float
+
+    :returns: A sorted array of the person_ids to keep. Use :py:func:`id_in_array` to check membership.
+    :rtype: array.array
+    """
+    logger.debug("Sampling %s persons from %s" % (sample,person_file))
+    with open(person_file,newline='') as f:
+        reader = csv.reader(f)
+        person_index = [h.strip().lower() for h in next(reader)].index('person_id')
+        person_ids = (row[person_index].strip() for row in reader if row)
+        if sample<1:
+            threshold = int(sample*0xFFFFFFFF)
+            kept = [int(p) for p in person_ids if zlib.crc32(p.encode())<=threshold]
+        else:
+            kept = [int(p) for p in heapq.nsmallest(int(sample),person_ids,key=lambda p:zlib.crc32(p.encode()))]
+    kept = array.array('q',sorted(kept))
+    logger.info("Sampled %d persons from %s" % (len(kept),person_file))
+    return kept
+
+def sample_parent_ids(table_map:tuple[str,str],person_ids:array.array)->dict[str,array.array]:
+    """
+    Collects the ids of the rows kept for sampled persons from the tables listed in :py:data:`SAMPLE_PARENT_TABLES`, so the tables which
+    reference them but have no person_id column (e.g. episode_event and note_nlp) can be filtered on them.
+
+    :param table_map: A list of tuples specifying a fully qualified file path and an OMOP table name i.e [(file name,table name)].
+    :type table_map: list(tuple)
+    :param person_ids: A sample of person_ids as returned from :py:func:`sample_person_ids`.
+    :type person_ids: array.array
+
+    :returns: A dict of {id column:sorted array of ids}. The array is empty if there is no file for the table.
+    :rtype: dict
+    """
+    parent_ids = {}
+    for parent_table,id_column in SAMPLE_PARENT_TABLES.items():
+        kept = []
+        for csv_file,table_name in table_map:
+            if table_name.lower()!=parent_table:
+                continue
+            logger.debug("Collecting %s for sampled persons from %s" % (id_column,csv_file))
+            with open(csv_file,newline='') as f:
+                reader = csv.reader(f)
+                headers = [h.strip().lower() for h in next(reader)]
+                person_index = headers.index('person_id')
+                id_index = headers.index(id_column)
+                kept += [int(row[id_index]) for row in reader if row and id_in_array(person_ids,row[person_index])]
+        parent_ids[id_column] = array.array('q',sorted(kept))
+        logger.info("Keeping %d %s ids for sampled persons" % (len(kept),id_column))
+    return parent_ids
+
+def csv_records(f:io.TextIOBase):
+    """
+    Reads a CSV file yielding each record both parsed and as the original text, so filtered records can be written out with their
+    original quoting. Quoted fields may span lines.
+
+    :param f: The CSV file opened with newline=''.
+    :type f: io.TextIOBase
+
+    :returns: A generator of (list of fields,original text) tuples
+    :rtype: generator
+    """
+    lines = []
+    def read_lines():
+        for line in f:
+            lines.append(line)
+            yield line
+    for row in csv.reader(read_lines()):
+        text = ''.join(lines)
+        lines.clear()
+        yield row,text
+
+def id_in_array(ids:array.array,id_value:str)->bool:
+    """
+    Checks whether an id is in a sorted array of ids as returned from :py:func:`sample_person_ids` or :py:func:`vocab_concept_ids`.
+
+    :param ids: A sorted array of ids.
+    :type ids: array.array
+    :param id_value: The id to check as read from a CSV file.
+    :type id_value: str
+
+    :returns: True if the id is in the array
+    :rtype: bool
+    """
+    try:
+        id_value = int(id_value)
+    except ValueError:
+        return False
+    i = bisect.bisect_left(ids,id_value)
+    return i<len(ids) and ids[i]==id_value
+
+def copy_csv_file(conn:psycopg.connection,table_name:str,headers:str,csv_file:str,server_copy:bool=False,
+                  sample_ids:dict[str,array.array]=None)->None:
+    """
+    Copies a CSV file with a header row into a table. If server_copy is set the server reads the file with :py:func:`copy_from_server`,
+    otherwise (or if that fails) the file is streamed from the client. If sample_ids is set and the file has any of its columns, only rows
+    whose values in all of those columns are in the sample are streamed to the table, with their original text.
+
+    :param conn: A psycopg connection object to the postgres database
+    :type conn: psycopg.connection
+    :param table_name: The schema qualified name of the table to copy into.
+    :type table_name: str
+    :param headers: The comma separated column names from the header row of the file.
+    :type headers: str
+    :param csv_file: The path to the CSV file.
+    :type csv_file: str
+    :param server_copy: Have the database server read the file itself. Defaults to False.
+    :type server_copy: bool
+    :param sample_ids: A dict of {column:sorted array of ids} e.g. person_id from :py:func:`sample_person_ids` and the ids from
+        :py:func:`sample_parent_ids`. Empty values are kept. Defaults to None which loads all rows.
+    :type sample_ids: dict
+
+    :returns: None
+    :rtype: None
+    """
+    columns = [c.strip().lower() for c in headers.split(',')]
+    if sample_ids and any(c in columns for c in sample_ids):
+        filters = [(columns.index(c),ids) for c,ids in sample_ids.items() if c in columns]
+        kept = 0
+        total = 0
+        with conn.cursor() as cur:
+            with open(csv_file,newline='') as f:
+                query = 'COPY %s (%s) FROM STDIN WITH(FORMAT CSV, HEADER)' % (table_name,headers)
+                logger.debug(query)
+                with cur.copy(query) as copy:
+                    records = csv_records(f)
+                    buffer = [next(records)[1]]
+                    size = 0
+                    for row,text in records:
+                        total += 1
+                        if row and all(row[i]=='' or id_in_array(ids,row[i]) for i,ids in filters):
+                            buffer.append(text)
+                            size += len(text)
+                            kept += 1
+                            if size>65536:
+                                copy.write(''.join(buffer))
+                                buffer = []
+                                size = 0
+                    copy.write(''.join(buffer))
+        logger.info("Loaded %d of %d rows into %s for sampled persons" % (kept,total,table_name))
+        return None
+    if server_copy:
+        query = "COPY %s (%s) FROM '%s' WITH(FORMAT CSV, HEADER)" % (table_name,headers,os.path.abspath(csv_file).replace("'","''"))
+        if copy_from_server(conn,query):
+            return None
+    with conn.cursor() as cur:
+        with open(csv_file) as f:
+            query = 'COPY %s (%s) FROM STDIN WITH(FORMAT CSV, HEADER)' % (table_name,headers)
+            logger.debug(query)
+            with cur.copy(query) as copy:
+                while data := f.read(100):
+                    copy.write(data)
+    return None
+
+def mark_derive_persons(conn:psycopg.connection,schema_name:str,source:str)->None:
+    """
+    Records the persons in the person_id column of source in yaol_derive_pending so the next :py:func:`derive_cdm` rebuilds them.
+
+    :param conn: A psycopg connection object to the postgres database
+    :type conn: psycopg.connection
+    :param schema_name: The name of the CDM schema.
+    :type schema_name: str
+    :param source: A table, or a query in brackets with an alias, with a person_id column.
+    :type source: str
+
+    :returns: None
+    :rtype: None
+    """
+    pending_table = "%s.yaol_derive_pending" % schema_name
+    with conn.cursor() as cur:
+        cur.execute("CREATE TABLE IF NOT EXISTS %s (person_id bigint PRIMARY KEY)" % pending_table)
+        sql = "INSERT INTO %s SELECT DISTINCT person_id FROM %s WHERE person_id IS NOT NULL ON CONFLICT DO NOTHING" % (pending_table,source)
+        logger.debug(sql)
+        cur.execute(sql)
+        logger.debug("Marked %d persons to derive" % cur.rowcount)
+    return None
+
+def load_data_csv(conn:psycopg.connection,db_schema:str,table_map:tuple[str,str],delete_first=False,server_copy:bool=False,
+                  sample_ids:dict[str,array.array]=None)->None:
     """
     Loads data from CSV files into OMOP tables. Expects one file per table. 
+    The persons loaded into (or deleted from) the tables in :py:data:`DERIVE_EVENT_TABLES` are recorded by :py:func:`mark_derive_persons`.
     N.B. This will not load data into any table which already contains data (i.e if count(*)>0).
 
     :param conn: A psycopg connection object to the postgres database
@@ -360,10 +873,19 @@ def load_data_csv(conn:psycopg.connection,db_schema:str,table_map:tuple[str,str]
     :type table_map: list(tuple)
     :param delete_first: Delete all rows from table before loading data. Defaults to False. Data will not be loaded to any table contaning data.
     :type delete_first: bool
+    :param server_copy: Have the database server read the files itself using COPY ... FROM 'file'. Falls back to streaming from the client
+        if the server cannot. Defaults to False.
+    :type server_copy: bool
+    :param sample_ids: A dict of {column:sorted array of ids} for the sampled persons as passed to :py:func:`copy_csv_file`.
+        Defaults to None which loads all rows.
+    :type sample_ids: dict
 
     :returns: None
     :rtype: None
     """
+    if server_copy and not dbutils.can_copy_on_server(conn,program=False):
+        logger.info("User cannot read files on the server. Loading data from the client")
+        server_copy = False
     disabled_table_list = []
     for csv_file,table_name in table_map:
         logger.debug("Got file %s for table %s" % (csv_file,table_name))
@@ -375,20 +897,583 @@ def load_data_csv(conn:psycopg.connection,db_schema:str,table_map:tuple[str,str]
             with conn.cursor() as cur:
                 if delete_first:
                     logger.debug("Delete contents of %s" % table_name)
+                    if table_name.lower() in DERIVE_EVENT_TABLES:
+                        mark_derive_persons(conn,db_schema,"%s.%s" % (db_schema,table_name))
                     cur.execute("ALTER TABLE %s.%s DISABLE TRIGGER ALL" % (db_schema,table_name))
                     disabled_table_list.append("%s.%s" % (db_schema,table_name))
                     cur.execute("DELETE FROM %s.%s" % (db_schema,table_name))
-                with open(csv_file) as f:
-                    query = 'COPY %s.%s (%s) FROM STDIN WITH(FORMAT CSV, HEADER)' % (db_schema,table_name,headers)
-                    with cur.copy(query) as copy:
-                        while data := f.read(100):
-                            copy.write(data)
+                copy_csv_file(conn,"%s.%s" % (db_schema,table_name),headers,csv_file,server_copy,sample_ids)
+                if table_name.lower() in DERIVE_EVENT_TABLES:
+                    mark_derive_persons(conn,db_schema,"%s.%s" % (db_schema,table_name))
                 for table in disabled_table_list:
                     cur.execute("ALTER TABLE %s.%s ENABLE TRIGGER ALL" % (db_schema,table_name))
         else:
             logger.debug("Table %s not empty. Skipping" % (table_name,))
     return None
 
+def read_pkeys(pkeys_file:str)->dict[str,tuple[str,list[str]]]:
+    """
+    Reads the primary keys from the OMOP Primary Keys file.
+
+    :param pkeys_file: The name of the file containing the SQL statements to create the Keys.
+    :type pkeys_file: str
+
+    :returns: A dict of {table name:(key name,[key columns])}
+    :rtype: dict
+    """
+    pkeys = {}
+    with open(pkeys_file) as f:
+        for line in f:
+            key = re.search('ALTER TABLE (.+) ADD CONSTRAINT (.+) PRIMARY KEY \((.+?)\)',line)
+            if key is None:
+                continue
+            table_name = key.group(1).split('.')[-1].strip().lower()
+            columns = [c.strip().lower() for c in key.group(3).split(',')]
+            pkeys[table_name] = (key.group(2).strip(),columns)
+            logger.debug("Got key %s for table %s" % (pkeys[table_name],table_name))
+    return pkeys
+
+def merge_data_csv(conn:psycopg.connection,db_schema:str,table_map:tuple[str,str],pkeys_file:str,server_copy:bool=False,
+                   delete_missing:bool=False)->dict[str,tuple[int,int,int]]:
+    """
+    Merges data from CSV files into OMOP tables which may already contain data. Expects one file per table.
+    Each file is copied into an unindexed temporary staging table, without the constraints of the table, which is then applied to the
+    table with INSERT ... ON CONFLICT (primary key) DO UPDATE. Tables with no primary key in the OMOP Primary Keys file are skipped. The keys must 
+    already exist on the tables and the key columns, including any partition columns added by :py:func:`build_pkeys`, are read from the
+    catalog. A file with more than one row for the same key is rejected.
+    Partitioned tables whose partition key is not part of the key in the Primary Keys file (e.g. range partitioned on a date) are merged by
+    deleting the rows with the same key from the file and inserting the staged rows, so a row can move between partitions. Columns missing
+    from the file keep their existing values. The persons whose rows in the tables in :py:data:`DERIVE_EVENT_TABLES` are merged are
+    recorded by :py:func:`mark_derive_persons`.
+
+    :param conn: A psycopg connection object to the postgres database
+    :type conn: psycopg.connection
+    :param db_schema: The name of the CDM schema.
+    :type db_schema: str
+    :param table_map: A list of tuples specifying a fully qualified file path and an OMOP table name to merge the data into i.e [(file name,table name)].
+    :type table_map: list(tuple)
+    :param pkeys_file: The name of the file containing the SQL statements to create the Keys.
+    :type pkeys_file: str
+    :param server_copy: Have the database server read the files itself. Defaults to False.
+    :type server_copy: bool
+    :param delete_missing: For each person in a file, delete rows from the table which are not in the file. Defaults to False.
+    :type delete_missing: bool
+
+    :returns: A dict of {table name:(inserted,updated,deleted)} row counts
+    :rtype: dict
+    """
+    if server_copy and not dbutils.can_copy_on_server(conn,program=False):
+        logger.info("User cannot read files on the server. Merging data from the client")
+        server_copy = False
+    pkeys = read_pkeys(pkeys_file)
+    counts = {}
+    for csv_file,table_name in table_map:
+        logger.debug("Got file %s for table %s" % (csv_file,table_name))
+        if not table_name.lower() in pkeys:
+            logger.warning("Table %s has no primary key. Cannot merge. Skipping" % (table_name,))
+            continue
+        key_name,file_key_columns = pkeys[table_name.lower()]
+        key_columns = dbutils.primary_key_columns(conn,db_schema,table_name)
+        if not key_columns:
+            raise ValueError("Primary key %s does not exist on %s.%s. Run the pkeys action before merging" % (key_name,db_schema,table_name))
+        partition_columns = dbutils.partition_columns(conn,db_schema,table_name)
+        replace_rows = not all(c in file_key_columns for c in partition_columns)
+        if replace_rows:
+            key_columns = file_key_columns
+        with open(csv_file) as f:
+            headers = f.readline().strip()
+        logger.debug("Got CSV headers:%s" % headers)
+        columns = [c.strip().lower() for c in headers.split(',')]
+        missing_columns = [c for c in key_columns if c not in columns]
+        if missing_columns:
+            raise ValueError("File %s does not contain key columns %s. Cannot merge" % (csv_file,missing_columns))
+        stage_table = "pg_temp.yaol_stage_%s" % table_name
+        logger.debug("Staging %s in %s" % (table_name,stage_table))
+        with conn.cursor() as cur:
+            cur.execute("DROP TABLE IF EXISTS %s" % stage_table)
+            cur.execute("CREATE TEMPORARY TABLE %s AS SELECT * FROM %s.%s WITH NO DATA" % (stage_table,db_schema,table_name))
+        copy_csv_file(conn,stage_table,headers,csv_file,server_copy)
+        with conn.cursor() as cur:
+            duplicate = cur.execute("SELECT %s FROM %s GROUP BY %s HAVING count(*)>1 LIMIT 1" % (
+                ','.join(key_columns),stage_table,','.join(key_columns))).fetchone()
+            if duplicate:
+                raise ValueError("File %s has more than one row for key (%s)=(%s). Cannot merge" % (
+                    csv_file,','.join(key_columns),','.join([str(v) for v in duplicate])))
+            key_match = ' AND '.join(["s.%s=t.%s" % (c,c) for c in key_columns])
+            if table_name.lower() in DERIVE_EVENT_TABLES:
+                mark_derive_persons(conn,db_schema,stage_table)
+                mark_derive_persons(conn,db_schema,"(SELECT t.person_id FROM %s.%s t JOIN %s s ON %s) moved" % (
+                    db_schema,table_name,stage_table,key_match))
+            deleted = 0
+            if delete_missing and 'person_id' in columns:
+                sql = "DELETE FROM %s.%s t WHERE t.person_id IN (SELECT person_id FROM %s) AND NOT EXISTS (SELECT 1 FROM %s s WHERE %s)" % (
+                    db_schema,table_name,stage_table,stage_table,key_match)
+                logger.debug(sql)
+                cur.execute(sql)
+                deleted = cur.rowcount
+            table_columns = dbutils.table_columns(conn,db_schema,table_name)
+            fill_columns = [c for c in table_columns if c not in columns]
+            if fill_columns:
+                sql = "UPDATE %s s SET %s FROM %s.%s t WHERE %s" % (
+                    stage_table,','.join(["%s=t.%s" % (c,c) for c in fill_columns]),db_schema,table_name,key_match)
+                logger.debug(sql)
+                cur.execute(sql)
+            if replace_rows:
+                logger.debug("Table %s is partitioned on %s. Replacing rows by key" % (table_name,partition_columns))
+                sql = "DELETE FROM %s.%s t USING %s s WHERE %s" % (db_schema,table_name,stage_table,key_match)
+                logger.debug(sql)
+                cur.execute(sql)
+                updated = cur.rowcount
+                sql = "INSERT INTO %s.%s (%s) SELECT %s FROM %s" % (
+                    db_schema,table_name,','.join(table_columns),','.join(table_columns),stage_table)
+                logger.debug(sql)
+                cur.execute(sql)
+                inserted = cur.rowcount-updated
+            else:
+                update_columns = [c for c in columns if c not in key_columns]
+                if update_columns:
+                    on_conflict = "DO UPDATE SET %s" % ','.join(["%s=EXCLUDED.%s" % (c,c) for c in update_columns])
+                else:
+                    on_conflict = "DO NOTHING"
+                sql = """WITH merged AS (INSERT INTO %s.%s (%s) SELECT %s FROM %s ON CONFLICT (%s) %s RETURNING (xmax=0) AS inserted)
+                         SELECT count(*) FILTER (WHERE inserted), count(*) FILTER (WHERE NOT inserted) FROM merged""" % (
+                    db_schema,table_name,','.join(table_columns),','.join(table_columns),stage_table,','.join(key_columns),on_conflict)
+                logger.debug(sql)
+                inserted,updated = cur.execute(sql).fetchone()
+            cur.execute("DROP TABLE %s" % stage_table)
+        counts[table_name] = (inserted,updated,deleted)
+        logger.info("Merged %s: %d inserted, %d updated, %d deleted" % (table_name,inserted,updated,deleted))
+    return counts
+
+def derive_sql(table_name:str,schema_name:str,vocab_schema_name:str,person_filter:str,persistence_window:int=30)->str:
+    """
+    Builds the set based INSERT statement for a derived table. Eras are built with window functions by starting a new era wherever an
+    event starts more than persistence_window days after the latest end of the earlier events for the same person and concept.
+    Drug and dose eras are built per ingredient using the concept_ancestor and drug_strength tables. Each person gets a single
+    observation_period, with the person_id as its id, covering all of their events with a period_type_concept_id of 32880 (Standard algorithm).
+
+    :param table_name: The derived table to build. One of observation_period, condition_era, drug_era or dose_era.
+    :type table_name: str
+    :param schema_name: The name of the CDM schema.
+    :type schema_name: str
+    :param vocab_schema_name: The name of the vocab schema.
+    :type vocab_schema_name: str
+    :param person_filter: A SQL condition on person_id selecting the persons to build rows for.
+    :type person_filter: str
+    :param persistence_window: The number of days allowed between events in the same era. Defaults to 30.
+    :type persistence_window: int
+
+    :returns: The INSERT statement.
+    :rtype: str
+    """
+    era_window = """SELECT *, SUM(is_start) OVER (PARTITION BY %(partition)s ORDER BY start_date, end_date ROWS UNBOUNDED PRECEDING) AS era
+             FROM (SELECT *, CASE WHEN start_date <= MAX(end_date) OVER (PARTITION BY %(partition)s ORDER BY start_date, end_date
+                                                                        ROWS BETWEEN UNBOUNDED PRECEDING AND 1 PRECEDING) + %(gap)d
+                                  THEN 0 ELSE 1 END AS is_start
+                   FROM %(source)s) starts"""
+    if table_name=='observation_period':
+        sql = """INSERT INTO %(schema)s.observation_period (observation_period_id,person_id,observation_period_start_date,
+                                                           observation_period_end_date,period_type_concept_id)
+                 SELECT person_id, person_id, MIN(start_date), MAX(end_date), 32880
+                 FROM (SELECT person_id, visit_start_date AS start_date, COALESCE(visit_end_date,visit_start_date) AS end_date
+                       FROM %(schema)s.visit_occurrence WHERE %(filter)s
+                       UNION ALL
+                       SELECT person_id, condition_start_date, COALESCE(condition_end_date,condition_start_date)
+                       FROM %(schema)s.condition_occurrence WHERE %(filter)s
+                       UNION ALL
+                       SELECT person_id, drug_exposure_start_date, COALESCE(drug_exposure_end_date,drug_exposure_start_date)
+                       FROM %(schema)s.drug_exposure WHERE %(filter)s
+                       UNION ALL
+                       SELECT person_id, procedure_date, COALESCE(procedure_end_date,procedure_date)
+                       FROM %(schema)s.procedure_occurrence WHERE %(filter)s
+                       UNION ALL
+                       SELECT person_id, device_exposure_start_date, COALESCE(device_exposure_end_date,device_exposure_start_date)
+                       FROM %(schema)s.device_exposure WHERE %(filter)s
+                       UNION ALL
+                       SELECT person_id, measurement_date, measurement_date
+                       FROM %(schema)s.measurement WHERE %(filter)s
+                       UNION ALL
+                       SELECT person_id, observation_date, observation_date
+                       FROM %(schema)s.observation WHERE %(filter)s) events
+                 GROUP BY person_id"""
+        return sql % {'schema':schema_name,'filter':person_filter}
+    if table_name=='condition_era':
+        source = """(SELECT person_id, condition_concept_id AS concept_id, condition_start_date AS start_date,
+                            COALESCE(condition_end_date,condition_start_date+1) AS end_date
+                     FROM %s.condition_occurrence WHERE condition_concept_id<>0 AND %s) events""" % (schema_name,person_filter)
+        sql = """INSERT INTO %(schema)s.condition_era (condition_era_id,person_id,condition_concept_id,condition_era_start_date,
+                                                      condition_era_end_date,condition_occurrence_count)
+                 SELECT nextval('%(schema)s.yaol_condition_era_id_seq'), person_id, concept_id, MIN(start_date), MAX(end_date), COUNT(*)
+                 FROM (%(eras)s) eras
+                 GROUP BY person_id, concept_id, era"""
+        eras = era_window % {'partition':'person_id, concept_id','gap':persistence_window,'source':source}
+        return sql % {'schema':schema_name,'eras':eras}
+    exposures = """SELECT de.person_id, ca.ancestor_concept_id AS concept_id, de.drug_exposure_start_date AS start_date,
+                          COALESCE(de.drug_exposure_end_date,de.drug_exposure_start_date+NULLIF(de.days_supply,0),
+                                   de.drug_exposure_start_date+1) AS end_date
+                   FROM %(schema)s.drug_exposure de
+                   JOIN %(vocab)s.concept_ancestor ca ON ca.descendant_concept_id=de.drug_concept_id
+                   JOIN %(vocab)s.concept c ON c.concept_id=ca.ancestor_concept_id
+                   WHERE c.vocabulary_id IN ('RxNorm','RxNorm Extension') AND c.concept_class_id='Ingredient'
+                   AND de.drug_concept_id<>0 AND %(filter)s""" % {'schema':schema_name,'vocab':vocab_schema_name,'filter':person_filter}
+    if table_name=='drug_era':
+        sub_exposures = """(SELECT person_id, concept_id, MIN(start_date) AS start_date, MAX(end_date) AS end_date, COUNT(*) AS exposure_count
+                            FROM (%s) sub_exposures
+                            GROUP BY person_id, concept_id, era) events"""
+        sub_exposures = sub_exposures % (era_window % {'partition':'person_id, concept_id','gap':0,'source':'(%s) events' % exposures})
+        sql = """INSERT INTO %(schema)s.drug_era (drug_era_id,person_id,drug_concept_id,drug_era_start_date,drug_era_end_date,
+                                                 drug_exposure_count,gap_days)
+                 SELECT nextval('%(schema)s.yaol_drug_era_id_seq'), person_id, concept_id, MIN(start_date), MAX(end_date), SUM(exposure_count),
+                        (MAX(end_date)-MIN(start_date))-SUM(end_date-start_date)
+                 FROM (%(eras)s) eras
+                 GROUP BY person_id, concept_id, era"""
+        eras = era_window % {'partition':'person_id, concept_id','gap':persistence_window,'source':sub_exposures}
+        return sql % {'schema':schema_name,'eras':eras}
+    if table_name=='dose_era':
+        source = """(SELECT de.person_id, ds.ingredient_concept_id AS concept_id, ds.amount_unit_concept_id AS unit_concept_id,
+                            ds.amount_value*de.quantity/GREATEST(COALESCE(NULLIF(de.days_supply,0),de.end_date-de.start_date),1) AS dose_value,
+                            de.start_date, de.end_date
+                     FROM (SELECT *, drug_exposure_start_date AS start_date,
+                                  COALESCE(drug_exposure_end_date,drug_exposure_start_date+NULLIF(days_supply,0),drug_exposure_start_date+1) AS end_date
+                           FROM %s.drug_exposure WHERE drug_concept_id<>0 AND quantity IS NOT NULL AND %s) de
+                     JOIN %s.drug_strength ds ON ds.drug_concept_id=de.drug_concept_id
+                     WHERE ds.amount_value IS NOT NULL AND ds.amount_unit_concept_id IS NOT NULL) events""" % (
+            schema_name,person_filter,vocab_schema_name)
+        sql = """INSERT INTO %(schema)s.dose_era (dose_era_id,person_id,drug_concept_id,unit_concept_id,dose_value,
+                                                 dose_era_start_date,dose_era_end_date)
+                 SELECT nextval('%(schema)s.yaol_dose_era_id_seq'), person_id, concept_id, unit_concept_id, dose_value,
+                        MIN(start_date), MAX(end_date)
+                 FROM (%(eras)s) eras
+                 GROUP BY person_id, concept_id, unit_concept_id, dose_value, era"""
+        eras = era_window % {'partition':'person_id, concept_id, unit_concept_id, dose_value','gap':persistence_window,'source':source}
+        return sql % {'schema':schema_name,'eras':eras}
+    raise ValueError("Unknown derived table %s" % table_name)
+
+def derive_person_range(conn_str:str,schema_name:str,vocab_schema_name:str,work_table:str,low:int,high:int,
+                        persistence_window:int=30,dryrun:bool=False)->dict[str,int]:
+    """
+    Rebuilds the derived tables for the persons in the work table with person_id between low and high on a new connection.
+    Existing rows for these persons are deleted first. Run by :py:func:`derive_cdm` for each person range in parallel.
+
+    :param conn_str: The postgres connection string.
+    :type conn_str: str
+    :param schema_name: The name of the CDM schema.
+    :type schema_name: str
+    :param vocab_schema_name: The name of the vocab schema.
+    :type vocab_schema_name: str
+    :param work_table: The schema qualified name of the table listing the person_ids to derive.
+    :type work_table: str
+    :param low: The lowest person_id in the range.
+    :type low: int
+    :param high: The highest person_id in the range.
+    :type high: int
+    :param persistence_window: The number of days allowed between events in the same era. Defaults to 30.
+    :type persistence_window: int
+    :param dryrun: Rollback rather than commit the changes. Defaults to False.
+    :type dryrun: bool
+
+    :returns: A dict of {table name:rows inserted}
+    :rtype: dict
+    """
+    person_filter = "person_id BETWEEN %d AND %d AND person_id IN (SELECT person_id FROM %s WHERE person_id BETWEEN %d AND %d)" % (
+        low,high,work_table,low,high)
+    counts = {}
+    with psycopg.connect(conn_str) as conn:
+        with conn.cursor() as cur:
+            for table_name in DERIVED_TABLES:
+                cur.execute("DELETE FROM %s.%s WHERE %s" % (schema_name,table_name,person_filter))
+                sql = derive_sql(table_name,schema_name,vocab_schema_name,person_filter,persistence_window)
+                logger.debug(sql)
+                cur.execute(sql)
+                counts[table_name] = cur.rowcount
+        if dryrun:
+            conn.rollback()
+        else:
+            conn.commit()
+    logger.debug("Derived persons %d to %d: %s" % (low,high,counts))
+    return counts
+
+def derive_cdm(conn:psycopg.connection,conn_str:str,schema_name:str,vocab_schema_name:str,workers:int=4,full:bool=False,
+               persistence_window:int=30,dryrun:bool=False)->dict[str,int]:
+    """
+    Builds the observation_period, condition_era, drug_era and dose_era tables from the loaded CDM data.
+    Only the persons recorded in yaol_derive_pending by :py:func:`mark_derive_persons` when their events were loaded or merged are rebuilt,
+    so unchanged persons are never read. A full rebuild derives every person in the person table.
+    The persons to rebuild are split into one person_id range per worker, each built by :py:func:`derive_person_range` on its own
+    connection, so the event tables need an index on person_id (see :py:func:`build_indicies`) to avoid a full scan per range.
+    N.B. The work table is committed on conn before the ranges are built and each range is committed separately, so a dry run must
+    start with no open transaction on conn.
+
+    :param conn: A psycopg connection object to the postgres database
+    :type conn: psycopg.connection
+    :param conn_str: The postgres connection string used to open a connection for each range.
+    :type conn_str: str
+    :param schema_name: The name of the CDM schema.
+    :type schema_name: str
+    :param vocab_schema_name: The name of the vocab schema.
+    :type vocab_schema_name: str
+    :param workers: The number of ranges to build in parallel. Defaults to 4.
+    :type workers: int
+    :param full: Empty the derived tables and rebuild every person. Defaults to False.
+    :type full: bool
+    :param persistence_window: The number of days allowed between events in the same era. Defaults to 30.
+    :type persistence_window: int
+    :param dryrun: Rollback rather than commit the changes for each range and leave the pending persons unchanged. Defaults to False.
+    :type dryrun: bool
+
+    :returns: A dict of {table name:rows inserted}
+    :rtype: dict
+    """
+    pending_table = "%s.yaol_derive_pending" % schema_name
+    work_table = "%s.yaol_derive_work" % schema_name
+    if dryrun and conn.info.transaction_status!=psycopg.pq.TransactionStatus.IDLE:
+        raise ValueError("Cannot dry run derive in an open transaction. The work table must be committed first")
+    for table_name in DERIVE_EVENT_TABLES:
+        if not dbutils.column_is_indexed(conn,schema_name,table_name,'person_id'):
+            logger.warning("Table %s.%s has no index on person_id. It will be scanned in full for each person range" % (schema_name,table_name))
+    with conn.cursor() as cur:
+        cur.execute("CREATE TABLE IF NOT EXISTS %s (person_id bigint PRIMARY KEY)" % pending_table)
+        if full and not dryrun:
+            logger.info("Emptying derived tables")
+            for table_name in DERIVED_TABLES:
+                cur.execute("TRUNCATE %s.%s" % (schema_name,table_name))
+        cur.execute("DROP TABLE IF EXISTS %s" % work_table)
+        if full:
+            sql = "CREATE UNLOGGED TABLE %s AS SELECT person_id FROM %s.person" % (work_table,schema_name)
+        else:
+            sql = "CREATE UNLOGGED TABLE %s AS SELECT person_id FROM %s" % (work_table,pending_table)
+        logger.debug(sql)
+        cur.execute(sql)
+        cur.execute("CREATE INDEX ON %s (person_id)" % work_table)
+        cur.execute("ANALYZE %s" % work_table)
+        for table_name in DERIVED_TABLES[1:]:
+            sequence = "%s.yaol_%s_id_seq" % (schema_name,table_name)
+            cur.execute("CREATE SEQUENCE IF NOT EXISTS %s" % sequence)
+            cur.execute("SELECT setval('%s',GREATEST((SELECT MAX(%s_id) FROM %s.%s),(SELECT last_value FROM %s),1))" % (
+                sequence,table_name,schema_name,table_name,sequence))
+        ranges = cur.execute("""SELECT MIN(person_id), MAX(person_id)
+                                FROM (SELECT person_id, ntile(%d) OVER (ORDER BY person_id) AS n FROM %s) ranges
+                                GROUP BY n ORDER BY 1""" % (workers,work_table)).fetchall()
+    conn.commit()
+    logger.info("Deriving tables for %d person ranges" % len(ranges))
+    counts = dict([(table_name,0) for table_name in DERIVED_TABLES])
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(derive_person_range,conn_str,schema_name,vocab_schema_name,work_table,low,high,persistence_window,dryrun)
+                   for low,high in ranges]
+        for future in concurrent.futures.as_completed(futures):
+            for table_name,count in future.result().items():
+                counts[table_name] += count
+    with conn.cursor() as cur:
+        if full and not dryrun:
+            cur.execute("TRUNCATE %s" % pending_table)
+        elif not dryrun:
+            cur.execute("DELETE FROM %s p USING %s w WHERE p.person_id=w.person_id" % (pending_table,work_table))
+        cur.execute("DROP TABLE %s" % work_table)
+    conn.commit()
+    for table_name,count in counts.items():
+        logger.info("Derived %d rows in %s" % (count,table_name))
+    return counts
+
+def snapshot_table(conn_str:str,snapshot_id:str,schema_name:str,table_name:str,columns:list[str],snapshot_file:str)->int:
+    """
+    Exports a table or partition to a gzip compressed file with COPY ... TO STDOUT (FORMAT BINARY) on a new connection. The connection uses
+    the exported snapshot so every table is exported as of the same point in time. Run by :py:func:`snapshot_cdm` for each table and
+    partition in parallel.
+
+    :param conn_str: The postgres connection string.
+    :type conn_str: str
+    :param snapshot_id: The id of a snapshot returned by pg_export_snapshot().
+    :type snapshot_id: str
+    :param schema_name: The name of the schema containing the table.
+    :type schema_name: str
+    :param table_name: The name of the table or partition to export.
+    :type table_name: str
+    :param columns: The names of the columns to export, in order.
+    :type columns: list
+    :param snapshot_file: The path of the file to write.
+    :type snapshot_file: str
+
+    :returns: The number of rows exported
+    :rtype: int
+    """
+    logger.debug("Exporting %s.%s to %s" % (schema_name,table_name,snapshot_file))
+    with psycopg.connect(conn_str) as conn:
+        conn.isolation_level = psycopg.IsolationLevel.REPEATABLE_READ
+        with conn.cursor() as cur:
+            cur.execute("SET TRANSACTION SNAPSHOT '%s'" % snapshot_id)
+            query = "COPY (SELECT %s FROM %s.%s) TO STDOUT (FORMAT BINARY)" % (','.join(columns),schema_name,table_name)
+            with gzip.open(snapshot_file,'wb',compresslevel=1) as f:
+                with cur.copy(query) as copy:
+                    for data in copy:
+                        f.write(data)
+            rows = cur.rowcount
+        conn.rollback()
+    logger.debug("Exported %d rows from %s.%s" % (rows,schema_name,table_name))
+    return rows
+
+def snapshot_cdm(conn_str:str,schema_name:str,vocab_schema_name:str,snapshot_path:str,workers:int=4)->dict:
+    """
+    Exports every table in the CDM and vocab schemas to a folder with one gzip compressed binary COPY file per table, or per partition
+    for partitioned tables, and a manifest.json describing them including the type of each column. Files are exported in parallel,
+    largest table first, by :py:func:`snapshot_table` using a snapshot exported from a single transaction so the files are consistent
+    with each other. Tables starting yaol\\_ are not exported.
+
+    :param conn_str: The postgres connection string.
+    :type conn_str: str
+    :param schema_name: The name of the CDM schema.
+    :type schema_name: str
+    :param vocab_schema_name: The name of the vocab schema.
+    :type vocab_schema_name: str
+    :param snapshot_path: The folder to write the snapshot to. It is created if it does not exist.
+    :type snapshot_path: str
+    :param workers: The number of files to export at once. Defaults to 4.
+    :type workers: int
+
+    :returns: The manifest
+    :rtype: dict
+    """
+    os.makedirs(snapshot_path,exist_ok=True)
+    with psycopg.connect(conn_str) as conn:
+        conn.isolation_level = psycopg.IsolationLevel.REPEATABLE_READ
+        with conn.cursor() as cur:
+            snapshot_id = cur.execute("SELECT pg_export_snapshot()").fetchone()[0]
+            server_version = cur.execute("SHOW server_version").fetchone()[0]
+        logger.debug("Exported snapshot %s" % snapshot_id)
+        tables = []
+        for table_schema in dict.fromkeys([schema_name,vocab_schema_name]):
+            for table_name in dbutils.list_tables(conn,table_schema):
+                if table_name.startswith('yaol_'):
+                    continue
+                role = 'vocab' if dbutils.is_vocab_table(table_name) else 'omop'
+                if (role=='vocab' and table_schema!=vocab_schema_name) or (role=='omop' and table_schema!=schema_name):
+                    continue
+                column_types = dbutils.table_column_types(conn,table_schema,table_name)
+                columns = [c for c,t in column_types]
+                types = [t for c,t in column_types]
+                partitions = dbutils.list_leaf_partitions(conn,table_schema,table_name)
+                if not partitions:
+                    tables.append({'role':role,'schema':table_schema,'table':table_name,'partition':None,
+                                   'file':"%s.%s.bin.gz" % (role,table_name),'columns':columns,'types':types})
+                for partition in partitions:
+                    tables.append({'role':role,'schema':table_schema,'table':table_name,'partition':partition,
+                                   'file':"%s.%s.bin.gz" % (role,partition),'columns':columns,'types':types})
+        logger.info("Exporting %d files to %s" % (len(tables),snapshot_path))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = dict([(executor.submit(snapshot_table,conn_str,snapshot_id,table['schema'],table['partition'] or table['table'],
+                                             table['columns'],os.path.join(snapshot_path,table['file'])),table) for table in tables])
+            for future in concurrent.futures.as_completed(futures):
+                table = futures[future]
+                table['rows'] = future.result()
+                logger.info("Exported %d rows from %s" % (table['rows'],table['partition'] or table['table']))
+        conn.rollback()
+    manifest = {'created':datetime.datetime.now().isoformat(),'server_version':server_version,'format':'binary','compression':'gzip',
+                'tables':[dict([(k,v) for k,v in table.items() if k!='schema']) for table in tables]}
+    with open(os.path.join(snapshot_path,'manifest.json'),'w') as f:
+        json.dump(manifest,f,indent=2)
+    return manifest
+
+def restore_table(conn_str:str,schema_name:str,table_name:str,columns:list[str],snapshot_file:str,dryrun:bool=False)->int:
+    """
+    Loads a file written by :py:func:`snapshot_table` into a table or partition with COPY ... FROM STDIN (FORMAT BINARY) on a new
+    connection. Run by :py:func:`restore_cdm` for each file in parallel.
+
+    :param conn_str: The postgres connection string.
+    :type conn_str: str
+    :param schema_name: The name of the schema containing the table.
+    :type schema_name: str
+    :param table_name: The name of the table or partition to load.
+    :type table_name: str
+    :param columns: The names of the columns in the file.
+    :type columns: list
+    :param snapshot_file: The path of the file to read.
+    :type snapshot_file: str
+    :param dryrun: Rollback rather than commit the load. Defaults to False.
+    :type dryrun: bool
+
+    :returns: The number of rows loaded.
+    :rtype: int
+    """
+    with psycopg.connect(conn_str) as conn:
+        logger.debug("Restoring %s.%s from %s" % (schema_name,table_name,snapshot_file))
+        with conn.cursor() as cur:
+            query = "COPY %s.%s (%s) FROM STDIN (FORMAT BINARY)" % (schema_name,table_name,','.join(columns))
+            with gzip.open(snapshot_file,'rb') as f:
+                with cur.copy(query) as copy:
+                    while data := f.read(65536):
+                        copy.write(data)
+            rows = cur.rowcount
+        if dryrun:
+            conn.rollback()
+        else:
+            conn.commit()
+    return rows
+
+def restore_cdm(conn_str:str,schema_name:str,vocab_schema_name:str,snapshot_path:str,workers:int=4,dryrun:bool=False)->None:
+    """
+    Loads a snapshot written by :py:func:`snapshot_cdm` into the CDM and vocab schemas. The tables must already exist, as built by 
+    :py:func:`build_cdm`, and are best restored before the foreign keys are built. The column types of every table are checked against
+    the manifest before anything is loaded. Files are loaded in parallel, largest first, by :py:func:`restore_table`. Each partition file
+    is loaded into the partition of the same name if the table has one, otherwise into the table. A file whose target table or partition
+    already contains data is skipped, so a failed restore can be rerun. A table loaded from several partition files which already contains
+    data cannot tell which files were loaded and raises an error. N.B. Each file is committed separately.
+
+    :param conn_str: The postgres connection string.
+    :type conn_str: str
+    :param schema_name: The name of the CDM schema to restore the data tables into.
+    :type schema_name: str
+    :param vocab_schema_name: The name of the vocab schema to restore the vocab tables into.
+    :type vocab_schema_name: str
+    :param snapshot_path: The folder containing the snapshot.
+    :type snapshot_path: str
+    :param workers: The number of files to load at once. Defaults to 4.
+    :type workers: int
+    :param dryrun: Rollback rather than commit the load of each file. Defaults to False.
+    :type dryrun: bool
+
+    :returns: None
+    :rtype: None
+    """
+    with open(os.path.join(snapshot_path,'manifest.json')) as f:
+        manifest = json.load(f)
+    tables = sorted(manifest['tables'],key=lambda t:os.path.getsize(os.path.join(snapshot_path,t['file'])),reverse=True)
+    partitions = {}
+    targets = {}
+    with psycopg.connect(conn_str) as conn:
+        for table in tables:
+            table_schema = vocab_schema_name if table['role']=='vocab' else schema_name
+            if not table['table'] in partitions:
+                column_types = dict(dbutils.table_column_types(conn,table_schema,table['table']))
+                if not column_types:
+                    raise ValueError("Table %s.%s does not exist. Cannot restore" % (table_schema,table['table']))
+                mismatched = ["%s %s (snapshot %s)" % (c,column_types.get(c,'missing'),t) for c,t in zip(table['columns'],table['types'])
+                              if column_types.get(c)!=t]
+                if mismatched:
+                    raise ValueError("Columns of %s.%s do not match the snapshot: %s" % (table_schema,table['table'],', '.join(mismatched)))
+                partitions[table['table']] = dbutils.list_leaf_partitions(conn,table_schema,table['table'])
+            table_name = table['partition'] if table['partition'] in partitions[table['table']] else table['table']
+            targets.setdefault((table_schema,table_name),[]).append(table)
+        for (table_schema,table_name),files in list(targets.items()):
+            if dbutils.table_is_empty(conn,table_schema,table_name):
+                continue
+            if len(files)>1:
+                raise ValueError("Table %s.%s is partly restored. It is loaded from %d partition files so empty it before restoring again" % (
+                    table_schema,table_name,len(files)))
+            logger.info("Table %s.%s not empty. Skipping" % (table_schema,table_name))
+            del targets[(table_schema,table_name)]
+        conn.rollback()
+    tables = [(table_schema,table_name,table) for (table_schema,table_name),files in targets.items() for table in files]
+    tables.sort(key=lambda t:os.path.getsize(os.path.join(snapshot_path,t[2]['file'])),reverse=True)
+    logger.info("Restoring %d files from %s" % (len(tables),snapshot_path))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {}
+        for table_schema,table_name,table in tables:
+            future = executor.submit(restore_table,conn_str,table_schema,table_name,table['columns'],
+                                     os.path.join(snapshot_path,table['file']),dryrun)
+            futures[future] = table_name
+        for future in concurrent.futures.as_completed(futures):
+            logger.info("Restored %d rows into %s" % (future.result(),futures[future]))
+    return None
+
 def get_args_parser()->argparse.ArgumentParser:
     """
     Builds a parser to handle the command line arguments.
@@ -415,6 +1500,23 @@ def get_args_parser()->argparse.ArgumentParser:
     parser.add_argument("--vocabschema", 
                         help='Vocab Schema. Overrides config.DB_VOCAB_SCHEMA',
                         )
+    parser.add_argument("--servercopy", 
+                        help='Have the database server read data and vocab files directly. Overrides config.SERVER_COPY',
+                        action='store_true'
+                        )
+    parser.add_argument("--sample-persons", 
+                        help='Load a consistent sample of persons given as a fraction (below 1) or a count. Overrides config.SAMPLE_PERSONS',
+                        type=float,
+                        )
+    parser.add_argument("--vocabularies", 
+                        help='Comma separated vocabulary_ids to load concepts from. Overrides config.VOCAB_IDS',
+                        )
+    parser.add_argument("--domains", 
+                        help='Comma separated domain_ids to load concepts from. Overrides config.VOCAB_DOMAINS',
+                        )
+    parser.add_argument("--partitions", 
+                        help='Tables to build as partitioned tables e.g. measurement=hash,observation=range. Overrides config.PARTITION_TABLES',
+                        )
 
     subparsers = parser.add_subparsers(help='Database operation',
                                        dest='action')
@@ -430,9 +1532,37 @@ def get_args_parser()->argparse.ArgumentParser:
     parser_op_load = subparsers.add_parser('load', help='Loads the CSV data')
     parser_op_pkeys = subparsers.add_parser('pkeys', help='Builds the primary keys')
     parser_op_index = subparsers.add_parser('index', help='Builds the indexes')
+    parser_op_index.add_argument("--workers", 
+                        help='Number of partition indexes to build at once. Overrides config.WORKERS. Commits the transaction first if more than 1 unless it is a dry run.',
+                        type=int,
+                        )
     parser_op_fkeys = subparsers.add_parser('fkeys', help='Builds the foreign keys')
     parser_op_all = subparsers.add_parser('all', help='Runs all actions except for clean')
     parser_op_reload = subparsers.add_parser('reload', help='Reloads the CSV data')
+    parser_op_derive = subparsers.add_parser('derive', help='Builds observation_period and the condition, drug and dose era tables')
+    parser_op_derive.add_argument("--full", 
+                        help='Rebuild every person rather than only those whose events were loaded or merged since the last derive.',
+                        action='store_true'
+                        )
+    parser_op_derive.add_argument("--workers", 
+                        help='Number of person ranges to build in parallel. Overrides config.WORKERS',
+                        type=int,
+                        )
+    parser_op_snapshot = subparsers.add_parser('snapshot', help='Exports every table to a compressed binary snapshot')
+    parser_op_restore = subparsers.add_parser('restore', help='Loads the tables from a snapshot')
+    for parser_op in [parser_op_snapshot,parser_op_restore]:
+        parser_op.add_argument("--path", 
+                            help='Snapshot folder. Overrides config.SNAPSHOT_PATH',
+                            )
+        parser_op.add_argument("--workers", 
+                            help='Number of table or partition files to export or load at once. Overrides config.WORKERS',
+                            type=int,
+                            )
+    parser_op_merge = subparsers.add_parser('merge', help='Merges the CSV data into tables which already contain data')
+    parser_op_merge.add_argument("--delete", 
+                        help='For each person in a file, delete rows which are not in the file.',
+                        action='store_true'
+                        )
 
     return parser
 
@@ -449,6 +1579,16 @@ def handle_args()->argparse.Namespace:
         config.DB_OMOP_SCHEMA = args.omopschema
     if not args.vocabschema is None:
         config.DB_VOCAB_SCHEMA = args.vocabschema
+    if not args.partitions is None:
+        config.PARTITION_TABLES = args.partitions
+    if args.servercopy:
+        config.SERVER_COPY = True
+    if not args.sample_persons is None:
+        config.SAMPLE_PERSONS = args.sample_persons
+    if not args.vocabularies is None:
+        config.VOCAB_IDS = args.vocabularies
+    if not args.domains is None:
+        config.VOCAB_DOMAINS = args.domains
     return args
 
 def setup_logging(debug:bool)->None:
@@ -492,7 +1632,8 @@ def clean(conn:psycopg.connection)->None: #action=="clean"
 def build(conn:psycopg.connection)->None: #action=="cdm"
     """
     Calls :py:func:`build_cdm` with the values of  :py:data:`config.DB_OMOP_SCHEMA`,
-    :py:data:`config.DDL_FILE` and  :py:data:`config.DB_RESULTS_SCHEMA`
+    :py:data:`config.DDL_FILE` and  :py:data:`config.DB_RESULTS_SCHEMA`. Tables in :py:data:`config.PARTITION_TABLES`
+    are built as partitioned tables.
 
     :param conn: A psycopg connection object to the postgres database
     :type conn: psycopg.connection
@@ -501,13 +1642,16 @@ def build(conn:psycopg.connection)->None: #action=="cdm"
     :rtype: None
     """
     logger.info("Building cdm")
-    build_cdm(conn,config.DB_OMOP_SCHEMA,config.DB_VOCAB_SCHEMA,config.DDL_FILE,config.DB_RESULTS_SCHEMA)
+    partitions = parse_partition_spec(config.PARTITION_TABLES)
+    build_cdm(conn,config.DB_OMOP_SCHEMA,config.DB_VOCAB_SCHEMA,config.DDL_FILE,config.DB_RESULTS_SCHEMA,
+              partitions,config.PARTITION_HASH_COUNT,config.PARTITION_RANGE_START,config.PARTITION_RANGE_END)
     return None
 
 def vocabs(conn:psycopg.connection,skip_check:bool=False)->None: #action=="vocabs":
     """
     Ensures tables are built by calling :py:func:`build()` and then Calls :py:func:`load_vocabs_file_zip` 
-    with the values of :py:data:`config.DB_OMOP_SCHEMA`, :py:data:`config.VOCABS_ZIP`.
+    with the values of :py:data:`config.DB_OMOP_SCHEMA`, :py:data:`config.VOCABS_ZIP`, :py:data:`config.SERVER_COPY`,
+    :py:data:`config.VOCAB_IDS` and :py:data:`config.VOCAB_DOMAINS`.
 
     :param conn: A psycopg connection object to the postgres database
     :type conn: psycopg.connection
@@ -520,13 +1664,17 @@ def vocabs(conn:psycopg.connection,skip_check:bool=False)->None: #action=="vocab
     if not skip_check:
         build(conn) 
     logger.info("Loading vocabs")
-    load_vocabs_from_zip(conn,config.DB_VOCAB_SCHEMA,config.VOCABS_ZIP) #action=="vocabs" #TODO Clean vocabs?
+    vocabulary_ids = [v.strip() for v in config.VOCAB_IDS.split(',') if v.strip()]
+    domain_ids = [d.strip() for d in config.VOCAB_DOMAINS.split(',') if d.strip()]
+    load_vocabs_from_zip(conn,config.DB_VOCAB_SCHEMA,config.VOCABS_ZIP,config.SERVER_COPY,vocabulary_ids,domain_ids) #action=="vocabs" #TODO Clean vocabs?
     return None
 
 def load(conn:psycopg.connection,delete_first:bool=False,skip_check:bool=False)->None: #action=="load"
     """
     Ensures vocabs are loaded by calling :py:func:`vocabs()`, builds a table to file map and then calls 
-    :py:func:`load_data_csv` with the values of and :py:data:`config.DB_OMOP_SCHEMA`.
+    :py:func:`load_data_csv` with the values of :py:data:`config.DB_OMOP_SCHEMA` and :py:data:`config.SERVER_COPY`.
+    If :py:data:`config.SAMPLE_PERSONS` is set the persons to load are chosen from the person file by :py:func:`sample_person_ids`
+    and the rows of tables without a person_id are kept by :py:func:`sample_parent_ids`.
 
     :param conn: A psycopg connection object to the postgres database
     :type conn: psycopg.connection
@@ -545,7 +1693,118 @@ def load(conn:psycopg.connection,delete_first:bool=False,skip_check:bool=False)-
         logger.info("Reloading data")
     else:
         logger.info("Loading data")
-    load_data_csv(conn,config.DB_OMOP_SCHEMA,table_map,delete_first) 
+    sample_ids = None
+    if config.SAMPLE_PERSONS:
+        person_files = [csv_file for csv_file,table_name in table_map if table_name.lower()=='person']
+        if not person_files:
+            raise ValueError("No person file found in %s. Cannot sample persons" % config.DATA_PATH)
+        person_ids = sample_person_ids(person_files[0],float(config.SAMPLE_PERSONS))
+        sample_ids = sample_parent_ids(table_map,person_ids)
+        sample_ids['person_id'] = person_ids
+    load_data_csv(conn,config.DB_OMOP_SCHEMA,table_map,delete_first,config.SERVER_COPY,sample_ids)
+    return None
+
+def merge(conn:psycopg.connection,delete_missing:bool=False,skip_check:bool=False)->None: #action=="merge"
+    """
+    Ensures vocabs are loaded by calling :py:func:`vocabs()`, builds a table to file map and then calls 
+    :py:func:`merge_data_csv` with the values of :py:data:`config.DB_OMOP_SCHEMA`, :py:data:`config.KEYS_FILE` and :py:data:`config.SERVER_COPY`.
+    The data is not loaded first, so the primary keys must already have been built by the pkeys action.
+
+    :param conn: A psycopg connection object to the postgres database
+    :type conn: psycopg.connection
+    :param delete_missing: For each person in a file, delete rows which are not in the file.
+    :type delete_missing: bool
+    :param skip_check: If true, no check is performed on the state of the database first.
+    :type conn: bool
+
+    :returns: None
+    :rtype: None
+    """
+    if not skip_check:
+        vocabs(conn)
+    table_map = build_table_map(config.DATA_PATTERN,config.DATA_PATH)
+    logger.info("Merging data")
+    merge_data_csv(conn,config.DB_OMOP_SCHEMA,table_map,config.KEYS_FILE,config.SERVER_COPY,delete_missing)
+    return None
+
+def derive(conn:psycopg.connection,full:bool=False,workers:int=None,dryrun:bool=False,skip_check:bool=False)->None: #action=="derive"
+    """
+    Ensures data is loaded and indexed by calling :py:func:`index()` then calls :py:func:`derive_cdm` with the values of
+    :py:data:`config.DB_CONN_STR`, :py:data:`config.DB_OMOP_SCHEMA`, :py:data:`config.DB_VOCAB_SCHEMA` and :py:data:`config.WORKERS`.
+    derive_cdm commits conn, so a dry run is refused unless skip_check is set.
+
+    :param conn: A psycopg connection object to the postgres database
+    :type conn: psycopg.connection
+    :param full: Rebuild every person rather than only those whose events were loaded or merged since the last derive.
+    :type full: bool
+    :param workers: The number of person ranges to build at once. Defaults to :py:data:`config.WORKERS`.
+    :type workers: int
+    :param dryrun: Rollback the changes made for each person range. Requires skip_check.
+    :type dryrun: bool
+    :param skip_check: If true, no check is performed on the state of the database first.
+    :type conn: bool
+
+    :returns: None
+    :rtype: None
+    """
+    if dryrun and not skip_check:
+        raise ValueError("A dry run of derive would commit the checks. Use --skipcheck with --dryrun")
+    if not skip_check:
+        index(conn)
+    logger.info("Deriving tables")
+    derive_cdm(conn,config.DB_CONN_STR,config.DB_OMOP_SCHEMA,config.DB_VOCAB_SCHEMA,workers or config.WORKERS,full,dryrun=dryrun)
+    return None
+
+def snapshot(conn:psycopg.connection,snapshot_path:str=None,workers:int=None,skip_check:bool=False)->None: #action=="snapshot"
+    """
+    Calls :py:func:`snapshot_cdm` with the values of :py:data:`config.DB_CONN_STR`, :py:data:`config.DB_OMOP_SCHEMA`,
+    :py:data:`config.DB_VOCAB_SCHEMA`, :py:data:`config.SNAPSHOT_PATH` and :py:data:`config.WORKERS`.
+    The snapshot only sees committed data so is taken before any other action in the same run.
+
+    :param conn: A psycopg connection object to the postgres database
+    :type conn: psycopg.connection
+    :param snapshot_path: The folder to write the snapshot to. Defaults to :py:data:`config.SNAPSHOT_PATH`.
+    :type snapshot_path: str
+    :param workers: The number of tables to export at once. Defaults to :py:data:`config.WORKERS`.
+    :type workers: int
+    :param skip_check: Not used. There is nothing to check before taking a snapshot.
+    :type conn: bool
+
+    :returns: None
+    :rtype: None
+    """
+    logger.info("Taking snapshot")
+    snapshot_cdm(config.DB_CONN_STR,config.DB_OMOP_SCHEMA,config.DB_VOCAB_SCHEMA,snapshot_path or config.SNAPSHOT_PATH,workers or config.WORKERS)
+    return None
+
+def restore(conn:psycopg.connection,snapshot_path:str=None,workers:int=None,dryrun:bool=False,skip_check:bool=False)->None: #action=="restore"
+    """
+    Ensures tables are built by calling :py:func:`build()` and then calls :py:func:`restore_cdm` with the values of
+    :py:data:`config.DB_CONN_STR`, :py:data:`config.DB_OMOP_SCHEMA`, :py:data:`config.DB_VOCAB_SCHEMA`, :py:data:`config.SNAPSHOT_PATH`
+    and :py:data:`config.WORKERS`. The build is committed first so the tables can be loaded on other connections, except on a dry run
+    which needs the tables to exist already.
+
+    :param conn: A psycopg connection object to the postgres database
+    :type conn: psycopg.connection
+    :param snapshot_path: The folder containing the snapshot. Defaults to :py:data:`config.SNAPSHOT_PATH`.
+    :type snapshot_path: str
+    :param workers: The number of files to load at once. Defaults to :py:data:`config.WORKERS`.
+    :type workers: int
+    :param dryrun: Rollback the load of each file.
+    :type dryrun: bool
+    :param skip_check: If true, no check is performed on the state of the database first.
+    :type conn: bool
+
+    :returns: None
+    :rtype: None
+    """
+    if not skip_check:
+        build(conn)
+        if not dryrun:
+            conn.commit()
+    logger.info("Restoring snapshot")
+    restore_cdm(config.DB_CONN_STR,config.DB_OMOP_SCHEMA,config.DB_VOCAB_SCHEMA,snapshot_path or config.SNAPSHOT_PATH,
+                workers or config.WORKERS,dryrun)
     return None
 
 def pkeys(conn:psycopg.connection,delete_first=False,skip_check:bool=False)->None:
@@ -569,10 +1828,12 @@ def pkeys(conn:psycopg.connection,delete_first=False,skip_check:bool=False)->Non
     build_pkeys(conn,config.DB_OMOP_SCHEMA,config.DB_VOCAB_SCHEMA,config.KEYS_FILE)
     return None
 
-def index(conn:psycopg.connection,delete_first=False,skip_check:bool=False)->None:
+def index(conn:psycopg.connection,delete_first=False,skip_check:bool=False,workers:int=None,dryrun:bool=False)->None:
     """
     Ensures keys are created by calling :py:func:`keys()` then calls :py:func:`build_indicies` with the values 
     :py:data:`config.DB_OMOP_SCHEMA`, :py:data:`config.DB_VOCAB_SCHEMA`, and :py:data:`config.INDICIES_FILE`.
+    If workers is more than 1 the transaction is committed first so the partition indexes can be built in parallel on other connections.
+    A dry run always builds them on conn.
 
     :param conn: A psycopg connection object to the postgres database
     :type conn: psycopg.connection
@@ -580,14 +1841,25 @@ def index(conn:psycopg.connection,delete_first=False,skip_check:bool=False)->Non
     :type delete_first: bool
     :param skip_check: If true, no check is performed on the state of the database first.
     :type conn: bool
+    :param workers: The number of partition indexes to build at once. Defaults to :py:data:`config.WORKERS`.
+    :type workers: int
+    :param dryrun: The transaction will be rolled back so must not be committed.
+    :type dryrun: bool
 
     :returns: None
     :rtype: None
     """
     if not skip_check:
         pkeys(conn)
+    workers = workers or config.WORKERS
+    if dryrun and workers>1:
+        logger.info("Dry run. Building partition indexes on one connection")
+        workers = 1
+    if workers>1:
+        logger.info("Committing before building partition indexes in parallel")
+        conn.commit()
     logger.info("Building indexes")
-    build_indicies(conn,config.DB_OMOP_SCHEMA,config.DB_VOCAB_SCHEMA,config.INDICIES_FILE)
+    build_indicies(conn,config.DB_OMOP_SCHEMA,config.DB_VOCAB_SCHEMA,config.INDICIES_FILE,config.DB_CONN_STR,workers)
     return None
 
 def fkeys(conn:psycopg.connection,delete_first=False,skip_check:bool=False)->None:
@@ -606,7 +1878,7 @@ def fkeys(conn:psycopg.connection,delete_first=False,skip_check:bool=False)->Non
     :rtype: None
     """
     if not skip_check:
-        index(conn)
+        index(conn,workers=1) # May be a dry run so build the indexes without committing
     logger.info("Adding foreign keys")
     build_fkeys(conn,config.DB_OMOP_SCHEMA,config.DB_VOCAB_SCHEMA,config.CONSTRAINTS_FILE)
     return None
@@ -617,6 +1889,10 @@ if __name__=="__main__":
     logger.debug("Running with args: %s" % (args,))
     skip_check = args.skipcheck
     with psycopg.connect(config.DB_CONN_STR) as conn:
+        if args.action=='snapshot':
+            snapshot(conn,args.path,args.workers,skip_check)
+        if args.action=='restore':
+            restore(conn,args.path,args.workers,args.dryrun,skip_check)
         if args.action=='clean':
             clean(conn)
         if args.action=='build' or args.action=='all':
@@ -627,10 +1903,14 @@ if __name__=="__main__":
             reload = (args.action=='reload')
             load(conn,reload,skip_check)
             #TODO We should probably have an option to rebuild indexes etc on a reload?
+        if args.action=='merge':
+            merge(conn,args.delete,skip_check)
+        if args.action=='derive':
+            derive(conn,args.full,args.workers,args.dryrun,skip_check)
         if args.action=='pkeys' or args.action=='all':
             pkeys(conn,False,skip_check)
         if args.action=='index' or args.action=='all':
-            index(conn,False,skip_check)
+            index(conn,False,skip_check,getattr(args,'workers',None),args.dryrun)
         if args.action=='fkeys' or args.action=='all':
             fkeys(conn,False,skip_check)
         if args.dryrun: